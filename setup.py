@@ -15,6 +15,9 @@ setup(
     install_requires=read_lines("requirements.txt"),
     extras_require={"dev": read_lines("requirements_dev.txt")},
     packages=find_packages(exclude=["docs"]),
+    entry_points={
+        "console_scripts": ["skills_taxonomy=skills_taxonomy.pipeline.run:app"]
+    },
     version="0.1.0",
     description="Identify meaningful groups of skills with a data driven approach",
     author="Jack Rasala",
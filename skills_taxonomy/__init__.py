@@ -1,15 +1,13 @@
 """skills_taxonomy."""
 import logging
-import logging.config
 from pathlib import Path
 from typing import Optional
 
-import yaml
-from dotenv import load_dotenv
-
 
 def get_yaml_config(file_path: Path) -> Optional[dict]:
     """Fetch yaml config and return as dict if it exists."""
+    import yaml
+
     if file_path.exists():
         with open(file_path, "rt") as f:
             return yaml.load(f.read(), Loader=yaml.FullLoader)
@@ -24,16 +22,45 @@ error_out = str(PROJECT_DIR / "errors.log")
 
 # Read log config file
 _log_config_path = Path(__file__).parent.resolve() / "config/logging.yaml"
-_logging_config = get_yaml_config(_log_config_path)
-if _logging_config:
-    logging.config.dictConfig(_logging_config)
+_logging_configured = False
+
+
+def configure_logging():
+    """Configure logging from the log config file, only once per process"""
+    global _logging_configured
+    if not _logging_configured:
+        import logging.config
+
+        _logging_configured = True
+        _logging_config = get_yaml_config(_log_config_path)
+        if _logging_config:
+            logging.config.dictConfig(_logging_config)
+
+
+class _LazyConfigLogger(logging.LoggerAdapter):
+    """Logger that configures logging the first time it logs a message,
+    rather than every time the package is imported"""
+
+    def log(self, level, msg, *args, **kwargs):
+        configure_logging()
+        super().log(level, msg, *args, **kwargs)
+
 
 # Define module logger
-logger = logging.getLogger(__name__)
+logger = _LazyConfigLogger(logging.getLogger(__name__), {})
 
 # base/global config
 _base_config_path = Path(__file__).parent.resolve() / "config/base.yaml"
-config = get_yaml_config(_base_config_path)
 
-# BUCKET and METAFLOW_PROFILE
-load_dotenv(f"{PROJECT_DIR}/.env.shared")
+
+def __getattr__(name: str):
+    """Load the base/global config, and BUCKET and METAFLOW_PROFILE from
+    .env.shared, the first time config is imported rather than on every import"""
+    if name == "config":
+        from dotenv import load_dotenv
+
+        global config
+        config = get_yaml_config(_base_config_path)
+        load_dotenv(f"{PROJECT_DIR}/.env.shared")
+        return config
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,17 +1,23 @@
 from skills_taxonomy.getters.esco_skills import get_output_skills
 from skills_taxonomy.pipeline.embedding import load_embedding
+from skills_taxonomy.pipeline.ann_index import (
+    load_or_build_ann_index,
+    query_ann_index,
+    recall_at_k,
+)
 from skills_taxonomy.utils.dir_management import make_dir_if_not_exist
 import os
 import random
-from sentence_transformers import util
-from skills_taxonomy import PROJECT_DIR
+import numpy as np
+from skills_taxonomy import logger, PROJECT_DIR
 
 
-def compare_skill(embedding, idx=None):
+def compare_skill(embedding, index, idx=None):
     """Display a skill its most similar skills in the embedding.
 
     Args:
         embedding (array): skills embedding
+        index (dict): approximate nearest neighbour index of the embedding
         idx (int): index to select skill,
             defaults to None (if None, a random index is chosen)
 
@@ -20,14 +26,14 @@ def compare_skill(embedding, idx=None):
             to in the embedding by cosine similarity
     """
     if idx is None:
-        description = embedding[random.randint(0, len(embedding))]
-    else:
-        description = embedding[idx]
+        idx = random.randrange(len(embedding))
+    neighbours, cosine_scores = query_ann_index(index, embedding, embedding[[idx]])
+    # the probed lists may hold fewer than k skills, the rest are padding
+    found = np.isfinite(cosine_scores[0])
     return (
         skills[["preferredLabel", "description"]]
-        .assign(cosine_scores=util.pytorch_cos_sim(description, embedding)[0])
-        .sort_values(by=["cosine_scores"], ascending=False)
-        .head(10)
+        .iloc[neighbours[0][found]]
+        .assign(cosine_scores=cosine_scores[0][found])
     )
 
 
@@ -47,6 +53,13 @@ def save_closest_skills(closest_skills):
 
 
 if __name__ == "__main__":
-    skills = get_output_skills()
+    skills = get_output_skills(columns=["preferredLabel", "description"])
     embedding = load_embedding()
-    save_closest_skills(compare_skill(embedding, idx=None))
+    index = load_or_build_ann_index(embedding)
+    query_indices = np.random.default_rng(0).choice(
+        len(embedding), min(1000, len(embedding)), replace=False
+    )
+    logger.info(
+        f"Index recall@10: {recall_at_k(index, embedding, query_indices, k=10):.3f}"
+    )
+    save_closest_skills(compare_skill(embedding, index, idx=None))
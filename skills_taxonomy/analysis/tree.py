@@ -1,86 +1,345 @@
+"""Index of the skills taxonomy tree of classes and subclasses, stored as arrays.
+
+Node 0 is the root, followed by a node for each class and then a node for each
+subclass, ordered by class then subclass. Each node has its parent, depth,
+class_id, subclass_id, label and count of skills, and the children of each node
+are stored in compressed sparse row form (child_offsets and children).
+
+The skills are stored sorted by node (skill_order), so that the skills under
+any node are a contiguous range of skill_order starting at the node's
+skill_start. The skills under a node, its path to the root and the counts of
+its subtree are found with array slicing, in time proportional to the output.
+
+The index is built from the class_id and subclass_id columns with a sort and
+bincounts, without a loop over the skills or nodes, and is saved as .npy files.
+The text and json views of the tree are rendered from the index.
+"""
 from skills_taxonomy.getters.esco_skills import get_output_skills
-from skills_taxonomy.utils.json_management import load_json, convert_dict_key_type
+from skills_taxonomy.utils.json_management import (
+    load_json,
+    convert_dict_key_type,
+    save_json,
+)
+from skills_taxonomy.utils.array_management import load_arrays, save_arrays
 from skills_taxonomy.utils.dir_management import make_dir_if_not_exist
 import os
-from treelib import Tree
 import numpy as np
 from skills_taxonomy import PROJECT_DIR
 
+TAXONOMY_ARRAYS = [
+    "parents",
+    "depths",
+    "class_ids",
+    "subclass_ids",
+    "labels",
+    "counts",
+    "skill_starts",
+    "child_offsets",
+    "children",
+    "skill_order",
+]
+ROOT = 0
 
-def counts(skills, id):
-    """Create dictionary with class or subclass id as keys and
-    counts of skills within that class or subclass as values
+
+def build_taxonomy_index(class_ids, subclass_ids, cls_lbls=None, subcls_lbls=None):
+    """Build the taxonomy index from the class and subclass of each skill
 
     Args:
-        skills (df): skills dataframe
-        id (str): choose 'class_id' or 'subclass_id'
+        class_ids (array): class id of each skill
+        subclass_ids (array): subclass id of each skill
+        cls_lbls (dict, optional): keys of class id, values of class label
+        subcls_lbls (dict, optional): keys of subclass id, values of subclass label
 
     Returns:
-        dict: keys = class or subclass id,
-            values = counts of skills within that class or subclass
+        dict: arrays of the index, with keys TAXONOMY_ARRAYS
     """
-    ids, counts = np.unique(skills[id], return_counts=True)
-    return dict(zip(ids, counts))
+    cls_lbls = cls_lbls or {}
+    subcls_lbls = subcls_lbls or {}
+    classes, class_index = np.unique(np.asarray(class_ids), return_inverse=True)
+    subclasses, subclass_index = np.unique(
+        np.asarray(subclass_ids), return_inverse=True
+    )
+    # a subclass is identified by its class and subclass id, rather than
+    # by deriving the class from the subclass id
+    pairs, pair_index = np.unique(
+        class_index.astype(np.int64) * len(subclasses) + subclass_index,
+        return_inverse=True,
+    )
+    pair_classes = pairs // len(subclasses)
+    pair_subclasses = subclasses[pairs % len(subclasses)]
+
+    n_classes = len(classes)
+    n_nodes = 1 + n_classes + len(pairs)
+    parents = np.concatenate([[-1], np.zeros(n_classes), 1 + pair_classes]).astype(
+        np.int64
+    )
+    depths = np.concatenate([[0], np.ones(n_classes), np.full(len(pairs), 2)]).astype(
+        np.int8
+    )
+
+    skill_nodes = 1 + n_classes + pair_index
+    counts = np.bincount(skill_nodes, minlength=n_nodes)
+    counts[1 : 1 + n_classes] = np.bincount(
+        pair_classes, weights=counts[1 + n_classes :], minlength=n_classes
+    )
+    counts[ROOT] = len(skill_nodes)
+    # nodes of each depth cover the skills in node order, so each node's
+    # skills start where the previous node of the same depth's skills stop
+    skill_starts = np.zeros(n_nodes, dtype=np.int64)
+    for depth in range(1, 3):
+        level = depths == depth
+        skill_starts[level] = np.cumsum(counts[level]) - counts[level]
+
+    return {
+        "parents": parents,
+        "depths": depths,
+        "class_ids": np.concatenate([[-1], classes, classes[pair_classes]]).astype(
+            np.int64
+        ),
+        "subclass_ids": np.concatenate(
+            [np.full(1 + n_classes, np.nan), pair_subclasses]
+        ),
+        "labels": np.array(
+            ["skills_taxonomy"]
+            + [str(cls_lbls.get(cls, cls)) for cls in classes]
+            + [str(subcls_lbls.get(sub_cls, sub_cls)) for sub_cls in pair_subclasses]
+        ),
+        "counts": counts,
+        "skill_starts": skill_starts,
+        "child_offsets": np.concatenate(
+            [[0], np.cumsum(np.bincount(parents[1:], minlength=n_nodes))]
+        ),
+        "children": np.argsort(parents[1:], kind="stable") + 1,
+        "skill_order": np.argsort(skill_nodes, kind="stable"),
+    }
 
 
-def add_class_nodes(cls_lbls, cls_counts):
-    """Add nodes to tree for class level
+def save_taxonomy_index(index, save_dir=PROJECT_DIR / "outputs/tree/index"):
+    """Save the taxonomy index arrays as .npy files
 
     Args:
-        cls_lbls (dict): keys of class id, values of class label
-        cls_counts (dict): keys of class id, values of count
+        index (dict): taxonomy index arrays
+        save_dir (Path, optional): directory to save the index,
+                            defaults to PROJECT_DIR/"outputs/tree/index"
     """
-    for cls in cls_lbls.keys():
-        tree.create_node(
-            f"{cls}: {cls_lbls[cls]}({cls_counts[cls]})",
-            cls_lbls[cls],
-            parent="skills_taxonomy",
-        )
+    save_arrays(index, TAXONOMY_ARRAYS, save_dir)
+
+
+def load_taxonomy_index(load_dir=PROJECT_DIR / "outputs/tree/index"):
+    """Load the taxonomy index arrays as memory maps
+
+    Args:
+        load_dir (Path, optional): directory the index was saved to,
+                            defaults to PROJECT_DIR/"outputs/tree/index"
+
+    Returns:
+        dict: taxonomy index arrays
+    """
+    return load_arrays(TAXONOMY_ARRAYS, load_dir)
+
+
+def find_node(index, class_id, subclass_id=None):
+    """Find the node of a class, or of a subclass of a class
+
+    Args:
+        index (dict): taxonomy index arrays
+        class_id (int): class id
+        subclass_id (float, optional): subclass id, if None the class node is found
+
+    Returns:
+        int: node, or None if the class or subclass is not in the taxonomy
+    """
+    classes = children(index, ROOT)
+    position = np.searchsorted(index["class_ids"][classes], class_id)
+    if position == len(classes) or index["class_ids"][classes[position]] != class_id:
+        return None
+    node = int(classes[position])
+    if subclass_id is None:
+        return node
+    subclasses = children(index, node)
+    position = np.searchsorted(index["subclass_ids"][subclasses], subclass_id)
+    if (
+        position == len(subclasses)
+        or index["subclass_ids"][subclasses[position]] != subclass_id
+    ):
+        return None
+    return int(subclasses[position])
+
+
+def children(index, node):
+    """Find the children of a node
+
+    Args:
+        index (dict): taxonomy index arrays
+        node (int): node
+
+    Returns:
+        array: child nodes
+    """
+    return index["children"][
+        index["child_offsets"][node] : index["child_offsets"][node + 1]
+    ]
+
+
+def skills_under(index, node):
+    """Find the skills under a node
+
+    Args:
+        index (dict): taxonomy index arrays
+        node (int): node
+
+    Returns:
+        array: row indices of the skills under the node
+    """
+    start = index["skill_starts"][node]
+    return index["skill_order"][start : start + index["counts"][node]]
 
 
-def add_subclass_nodes(subcls_lbls, subcls_counts, cls_lbls):
-    """Add nodes to tree for subclass level
+def path_to_root(index, node):
+    """Find the path from a node to the root
 
     Args:
-        subcls_lbls (dict): keys of subclass id, values of subclass label
-        subcls_counts (dict): keys of subclass id, values of count
-        cls_lbls (dict): keys of class id, values of class label
+        index (dict): taxonomy index arrays
+        node (int): node
+
+    Returns:
+        array: nodes from node to the root
     """
-    for sub_cls in subcls_lbls.keys():
-        tree.create_node(
-            f"{sub_cls}: {subcls_lbls[sub_cls]}({subcls_counts[sub_cls]})",
-            subcls_lbls[sub_cls],
-            parent=cls_lbls[int(sub_cls)],
+    path = [node]
+    while index["parents"][path[-1]] != -1:
+        path.append(index["parents"][path[-1]])
+    return np.asarray(path)
+
+
+def subtree(index, node):
+    """Find a node and its descendants. Nodes are stored in depth order, and
+    the children of consecutive nodes are consecutive, so each depth of the
+    subtree is a slice of children
+
+    Args:
+        index (dict): taxonomy index arrays
+        node (int): node
+
+    Returns:
+        array: nodes of the subtree in depth order, starting with node
+    """
+    levels = [np.asarray([node])]
+    while len(levels[-1]):
+        level = levels[-1]
+        levels.append(
+            index["children"][
+                index["child_offsets"][level[0]] : index["child_offsets"][level[-1] + 1]
+            ]
         )
+    return np.concatenate(levels)
+
 
+def subtree_counts(index, node):
+    """Find the counts of skills of a node and its descendants
 
-def save_tree(save_path=f"{PROJECT_DIR}/outputs/tree/tree.txt"):
-    """Save tree if dir for save_path exists, if not make dir"""
-    make_dir_if_not_exist(os.path.dirname(save_path))
-    tree.save2file(save_path)
+    Args:
+        index (dict): taxonomy index arrays
+        node (int): node
+
+    Returns:
+        dict: keys of node, values of count of skills under the node
+    """
+    nodes = subtree(index, node)
+    return dict(zip(nodes.tolist(), np.asarray(index["counts"])[nodes].tolist()))
 
 
-def make_skills_taxonomy_tree():
-    """Add class and subclass nodes to the tree"""
-    tree.create_node(f"skills_taxonomy({len(skills)})", "skills_taxonomy")
-    # add class nodes
-    cls_lbls = convert_dict_key_type(
-        load_json(f"{PROJECT_DIR}/outputs/named_classes/named_classes_x.json"), type=int
-    )
-    add_class_nodes(cls_lbls, cls_counts=counts(skills, id="class_id"))
-    # add sub class nodes
-    add_subclass_nodes(
+def node_tag(index, node):
+    """Describe a node with its id, label and count of skills"""
+    depth = index["depths"][node]
+    if depth == 0:
+        return f"{index['labels'][node]}({index['counts'][node]})"
+    node_id = index["class_ids"][node] if depth == 1 else index["subclass_ids"][node]
+    return f"{node_id}: {index['labels'][node]}({index['counts'][node]})"
+
+
+def render_text(index, node=ROOT, prefix=""):
+    """Render the tree under a node as text, one node per line
+
+    Args:
+        index (dict): taxonomy index arrays
+        node (int): node to render the tree under, defaults to the root
+        prefix (str): characters to start the children's lines with
+
+    Returns:
+        list of strs: lines of the tree
+    """
+    lines = [node_tag(index, node)] if not prefix else []
+    child_nodes = children(index, node)
+    for i, child in enumerate(child_nodes):
+        last = i == len(child_nodes) - 1
+        lines.append(f"{prefix}{'└── ' if last else '├── '}{node_tag(index, child)}")
+        lines.extend(render_text(index, child, prefix + ("    " if last else "│   ")))
+    return lines
+
+
+def render_json(index, node=ROOT):
+    """Render the tree under a node as nested dictionaries
+
+    Args:
+        index (dict): taxonomy index arrays
+        node (int): node to render the tree under, defaults to the root
+
+    Returns:
+        dict: id, label, count and children of the node
+    """
+    depth = index["depths"][node]
+    return {
+        "id": None
+        if depth == 0
+        else int(index["class_ids"][node])
+        if depth == 1
+        else float(index["subclass_ids"][node]),
+        "label": str(index["labels"][node]),
+        "count": int(index["counts"][node]),
+        "children": [render_json(index, child) for child in children(index, node)],
+    }
+
+
+def save_tree(index, save_dir=f"{PROJECT_DIR}/outputs/tree/"):
+    """Save text and json renderings of the tree, making save_dir if it does not exist
+
+    Args:
+        index (dict): taxonomy index arrays
+        save_dir (str): path to directory to save the tree,
+            defaults to f"{PROJECT_DIR}/outputs/tree/"
+    """
+    make_dir_if_not_exist(save_dir)
+    with open(os.path.join(save_dir, "tree.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(render_text(index)) + "\n")
+    save_json(save_dir, "tree.json", render_json(index))
+
+
+def make_skills_taxonomy_index(skills):
+    """Build the taxonomy index of skills with the named classes and subclasses
+
+    Args:
+        skills (df): skills dataframe with class_id and subclass_id columns
+
+    Returns:
+        dict: taxonomy index arrays
+    """
+    return build_taxonomy_index(
+        skills["class_id"].to_numpy(),
+        skills["subclass_id"].to_numpy(),
+        cls_lbls=convert_dict_key_type(
+            load_json(f"{PROJECT_DIR}/outputs/named_classes/named_classes_x.json"),
+            type=int,
+        ),
         subcls_lbls=convert_dict_key_type(
             load_json(f"{PROJECT_DIR}/outputs/named_classes/named_subclasses_x.json"),
             type=float,
         ),
-        subcls_counts=counts(skills, id="subclass_id"),
-        cls_lbls=cls_lbls,
     )
 
 
 if __name__ == "__main__":
-    skills = get_output_skills()
-    tree = Tree()
-    make_skills_taxonomy_tree()
-    save_tree()
+    index = make_skills_taxonomy_index(
+        get_output_skills(columns=["class_id", "subclass_id"])
+    )
+    save_taxonomy_index(index)
+    save_tree(index)
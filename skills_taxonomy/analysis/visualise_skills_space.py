@@ -1,24 +1,89 @@
 from skills_taxonomy.getters.esco_skills import get_output_skills
 from skills_taxonomy.pipeline.embedding import load_embedding
 from skills_taxonomy.utils.dir_management import make_dir_if_not_exist
+from skills_taxonomy.utils.fingerprint import array_fingerprint
 import os.path
-from sklearn.manifold import TSNE
-import seaborn as sns
-import matplotlib.pyplot as plt
 import numpy as np
-from skills_taxonomy import PROJECT_DIR
+import pandas as pd
+from skills_taxonomy import config, PROJECT_DIR
 
 
-def reduce_dims(embedding):
-    """Using TSNE, reduce dimensions of skills embedding
+def reduce_dims(
+    embedding,
+    backend=config["visualisation"]["backend"],
+    pca_components=config["visualisation"]["pca_components"],
+    n_jobs=config["visualisation"]["n_jobs"],
+):
+    """Reduce dimensions of skills embedding to 2, first with PCA and then
+    with TSNE or UMAP. PCA removes the noisiest dimensions and makes
+    the nearest neighbour search in TSNE and UMAP much faster.
 
     Args:
         embedding (array): skills embedding with 768 dimensions
+        backend (str, optional): 'opentsne' for openTSNE's FFT accelerated TSNE,
+            'umap' for UMAP or 'sklearn' for sklearn's TSNE
+        pca_components (int, optional): number of dimensions to reduce to with PCA
+        n_jobs (int, optional): number of threads to use
+
+    Returns:
+        array: skills embedding with 2 dimensions
+    """
+    from sklearn.decomposition import PCA
+
+    embedding = PCA(
+        n_components=min(pca_components, *embedding.shape), random_state=0
+    ).fit_transform(embedding)
+    if backend == "opentsne":
+        from openTSNE import TSNE
+
+        return np.asarray(
+            TSNE(negative_gradient_method="fft", n_jobs=n_jobs, random_state=0).fit(
+                embedding
+            )
+        )
+    if backend == "umap":
+        from umap import UMAP
+
+        return UMAP(n_jobs=n_jobs).fit_transform(embedding)
+    if backend == "sklearn":
+        from sklearn.manifold import TSNE
+
+        return TSNE(n_components=2, n_jobs=n_jobs, random_state=0).fit_transform(
+            embedding
+        )
+    raise ValueError(f"Unknown dimension reduction backend {backend}")
+
+
+def load_or_reduce_dims(
+    embedding,
+    backend=config["visualisation"]["backend"],
+    pca_components=config["visualisation"]["pca_components"],
+    layout_dir=PROJECT_DIR / "outputs/models/layout",
+):
+    """Load the 2 dimensional skills embedding if it has been saved before,
+    otherwise compute and save it. Layouts are saved with the fingerprint
+    of the embedding they were computed from in their file name, so plots
+    with different colourings reuse the same layout.
+
+    Args:
+        embedding (array): skills embedding
+        backend (str, optional): dimension reduction backend, see reduce_dims
+        pca_components (int, optional): number of dimensions to reduce to with PCA
+        layout_dir (Path, optional): directory of saved layouts,
+                            defaults to PROJECT_DIR/"outputs/models/layout"
 
     Returns:
         array: skills embedding with 2 dimensions
     """
-    return TSNE(n_components=2).fit_transform(embedding)
+    layout_path = (
+        layout_dir / f"{backend}_{pca_components}_{array_fingerprint(embedding)}.npy"
+    )
+    if layout_path.exists():
+        return np.load(layout_path)
+    embedding_2d = reduce_dims(embedding, backend, pca_components)
+    make_dir_if_not_exist(layout_dir)
+    np.save(layout_path, embedding_2d)
+    return embedding_2d
 
 
 def add_points_to_skills(skills, embedding_2d):
@@ -35,34 +100,144 @@ def add_points_to_skills(skills, embedding_2d):
     return skills.assign(x=embedding_2d[:, 0], y=embedding_2d[:, 1])
 
 
+def density_raster(x, y, categories, bins, extent=None):
+    """Count the points of each category in each cell of a bins x bins grid,
+    in a single pass over the points
+
+    Args:
+        x (array): x coordinates of points
+        y (array): y coordinates of points
+        categories (array): category of each point, points with missing
+            categories are not counted
+        bins (int): number of grid cells along each axis
+        extent (tuple, optional): (x_min, x_max, y_min, y_max) of the grid,
+            defaults to None (if None, the extent of the points is used).
+            An axis with no range is padded by 0.5 on each side
+
+    Returns:
+        array: sorted unique categories
+        array: counts with shape (number of categories, bins, bins)
+        tuple: extent of the grid
+    """
+    codes, uniques = pd.factorize(categories, sort=True)
+    if extent is None:
+        extent = (x.min(), x.max(), y.min(), y.max())
+    x_min, x_max, y_min, y_max = extent
+    # pad an axis whose points all share one value, so the grid has a width
+    if x_max == x_min:
+        x_min, x_max = x_min - 0.5, x_max + 0.5
+    if y_max == y_min:
+        y_min, y_max = y_min - 0.5, y_max + 0.5
+    extent = (x_min, x_max, y_min, y_max)
+    x_bin = np.clip(((x - x_min) / (x_max - x_min) * bins).astype(int), 0, bins - 1)
+    y_bin = np.clip(((y - y_min) / (y_max - y_min) * bins).astype(int), 0, bins - 1)
+    counted = codes >= 0
+    counts = np.bincount(
+        ((codes * bins + y_bin) * bins + x_bin)[counted],
+        minlength=len(uniques) * bins * bins,
+    )
+    return uniques, counts.reshape(len(uniques), bins, bins), extent
+
+
+def shade_raster(counts, colours):
+    """Colour each grid cell by the mean colour of the categories of its points,
+    with an opacity that increases with the log of its number of points
+
+    Args:
+        counts (array): counts with shape (number of categories, bins, bins)
+        colours (array): RGB colour of each category
+
+    Returns:
+        array: RGBA image with shape (bins, bins, 4)
+    """
+    total = counts.sum(axis=0)
+    rgb = np.einsum("cij,ck->ijk", counts, colours) / np.maximum(total, 1)[..., None]
+    alpha = np.log1p(total) / np.log1p(max(total.max(), 1))
+    return np.dstack([rgb, alpha])
+
+
+def plot_points(
+    skills,
+    hue,
+    palette,
+    mode=config["visualisation"]["plot_mode"],
+    bins=config["visualisation"]["raster_bins"],
+    **legend_kwargs,
+):
+    """Plot the skills as points on the current axes coloured by hue,
+    either as a scatter plot or as a density raster drawn with a single imshow.
+    The size of a density raster does not depend on the number of skills.
+
+    Args:
+        skills (df): skills dataframe with x and y columns
+        hue (str): column to colour the points by
+        palette (str): seaborn colour palette
+        mode (str, optional): 'scatter' or 'raster'
+        bins (int, optional): number of raster cells along each axis
+        legend_kwargs: keyword arguments for plt.legend, to place the legend
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Patch
+    import seaborn as sns
+
+    if mode == "scatter":
+        sns.scatterplot(
+            data=skills, x="x", y="y", hue=hue, palette=palette, s=10, legend="full"
+        )
+        if legend_kwargs:
+            plt.legend(title=hue, **legend_kwargs)
+        return
+    if mode != "raster":
+        raise ValueError(f"Unknown plot mode {mode}")
+    categories, counts, extent = density_raster(
+        skills["x"].to_numpy(), skills["y"].to_numpy(), skills[hue], bins
+    )
+    colours = np.array(sns.color_palette(palette, len(categories)))
+    plt.imshow(
+        shade_raster(counts, colours),
+        origin="lower",
+        extent=extent,
+        aspect="auto",
+        interpolation="nearest",
+    )
+    plt.legend(
+        handles=[
+            Patch(color=colour, label=category)
+            for category, colour in zip(categories, colours)
+        ],
+        title=hue,
+        **legend_kwargs,
+    )
+
+
 def plot_skills_space(
-    skills, save_path=f"{PROJECT_DIR}/outputs/figures/skills_space.jpeg"
+    skills,
+    mode=config["visualisation"]["plot_mode"],
+    save_path=f"{PROJECT_DIR}/outputs/figures/skills_space.jpeg",
 ):
     """Save two plots of the skills space, one colouring the points by
     class, one colouring the points by subclass
 
     Args:
         skills (df): skills dataframe
+        mode (str, optional): 'scatter' or 'raster', see plot_points
         save_path (str): path to save the plot,
             defaults to f"{PROJECT_DIR}/outputs/figures/skills_space.jpeg"
     """
+    import matplotlib.pyplot as plt
+
     plt.subplots(figsize=(30, 15))
     plt.subplot(1, 2, 1)
-    sns.scatterplot(
-        data=skills, x="x", y="y", hue="class_lbl", palette="tab10", s=10, legend="full"
-    )
+    plot_points(skills, "class_lbl", "tab10", mode)
     plt.subplot(1, 2, 2)
-    sns.scatterplot(
-        data=skills,
-        x="x",
-        y="y",
-        hue="subclass_lbl",
-        palette="husl",
-        s=10,
-        legend="full",
-    )
-    plt.legend(
-        bbox_to_anchor=(1.01, 0.465), loc=2, borderaxespad=0.0, title="subclass_lbl"
+    plot_points(
+        skills,
+        "subclass_lbl",
+        "husl",
+        mode,
+        bbox_to_anchor=(1.01, 0.465),
+        loc=2,
+        borderaxespad=0.0,
     )
     make_dir_if_not_exist(os.path.dirname(save_path))
     plt.savefig(save_path)
@@ -72,6 +247,7 @@ def plot_subclass_skills_space(
     skills,
     nrows=3,
     ncols=3,
+    mode=config["visualisation"]["plot_mode"],
     save_path=f"{PROJECT_DIR}/outputs/figures/subclass_skills_space.jpeg",
 ):
     """Save figure with multiple sub plots for the skills space
@@ -81,32 +257,26 @@ def plot_subclass_skills_space(
         skills (df): skills dataframe
         nrows (int): number of rows in the subplot, defaults to 3.
         ncols (int): number of columns in the subplot, defaults to 3.
+        mode (str, optional): 'scatter' or 'raster', see plot_points
         save_path (str): path to save the plot, defaults
                 to f"{PROJECT_DIR}/outputs/figures/subclass_skills_space.jpeg".
     """
+    import matplotlib.pyplot as plt
+
     plt.subplots(figsize=(18, 18))
-    for i in np.unique(skills["class_id"]):
-        plt.subplot(nrows, ncols, i + 1)
-        sub_points = skills[
-            (skills["subclass_id"] < i + 1) & (skills["subclass_id"] >= i)
-        ]
-        sns.scatterplot(
-            data=sub_points,
-            x="x",
-            y="y",
-            hue="subclass_lbl",
-            palette="tab10",
-            s=10,
-            legend="full",
-        )
+    for class_id, sub_points in skills.groupby("class_id"):
+        plt.subplot(nrows, ncols, class_id + 1)
+        plot_points(sub_points, "subclass_lbl", "tab10", mode)
     make_dir_if_not_exist(os.path.dirname(save_path))
     plt.savefig(save_path)
 
 
 if __name__ == "__main__":
-    skills = get_output_skills()
+    skills = get_output_skills(
+        columns=["class_id", "subclass_id", "class_lbl", "subclass_lbl"]
+    )
     embedding = load_embedding()
-    embedding_2d = reduce_dims(embedding)
+    embedding_2d = load_or_reduce_dims(embedding)
     skills = add_points_to_skills(skills, embedding_2d)
     plot_skills_space(skills)
     plot_subclass_skills_space(skills)
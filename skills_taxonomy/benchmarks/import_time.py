@@ -0,0 +1,115 @@
+"""Check the import time of the package's entry points
+
+Each entry point module is imported in a fresh interpreter with
+python -X importtime. The check fails if importing an entry point takes
+longer than a time budget, or imports a heavy dependency which should only be
+imported when it is used, such as sentence_transformers and torch for encoding
+or matplotlib and seaborn for plotting. Logging is configured when the first
+message is logged, so logging.config should not be imported either.
+
+Usage:
+    python skills_taxonomy/benchmarks/import_time.py [--budget-s 1.0]
+"""
+import subprocess
+import sys
+import typer
+from skills_taxonomy import logger, PROJECT_DIR
+
+ENTRY_POINTS = [
+    "skills_taxonomy",
+    "skills_taxonomy.pipeline.run",
+    "skills_taxonomy.pipeline.similarity_service",
+    "skills_taxonomy.pipeline.assign_skills",
+    "skills_taxonomy.analysis.tree",
+    "skills_taxonomy.analysis.compare_skills",
+    "skills_taxonomy.analysis.visualise_skills_space",
+]
+LAZY_MODULES = [
+    "sentence_transformers",
+    "torch",
+    "seaborn",
+    "matplotlib",
+    "sklearn.manifold",
+    "openTSNE",
+    "umap",
+    "onnxruntime",
+    "logging.config",
+]
+
+
+def import_times(module):
+    """Import a module in a fresh interpreter and find the cumulative
+    import time of every module it imports
+
+    Args:
+        module (str): name of the module to import
+
+    Returns:
+        dict: cumulative import time in seconds of each imported module
+    """
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=PROJECT_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    times = {}
+    for line in stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def check_import_times(entry_points=ENTRY_POINTS, budget_s=1.0):
+    """Find the entry points which are slow to import or import lazy modules
+
+    Args:
+        entry_points (list of strs): names of the modules to import
+        budget_s (float): maximum import time of an entry point in seconds
+
+    Returns:
+        dict: import time of each entry point
+        list of strs: descriptions of the failed checks
+    """
+    entry_point_times = {}
+    failures = []
+    for module in entry_points:
+        times = import_times(module)
+        entry_point_times[module] = times[module]
+        if times[module] > budget_s:
+            failures.append(
+                f"{module} took {times[module]:.2f}s to import, budget {budget_s}s"
+            )
+        eager = [
+            lazy_module
+            for lazy_module in LAZY_MODULES
+            if any(
+                name == lazy_module or name.startswith(f"{lazy_module}.")
+                for name in times
+            )
+        ]
+        if eager:
+            failures.append(f"{module} imports {', '.join(eager)}")
+    return entry_point_times, failures
+
+
+app = typer.Typer()
+
+
+@app.command()
+def run(budget_s: float = 1.0):
+    """Check the import time of the package's entry points"""
+    entry_point_times, failures = check_import_times(budget_s=budget_s)
+    for module, seconds in entry_point_times.items():
+        logger.info(f"{module}: {seconds:.2f}s")
+    for failure in failures:
+        logger.warning(f"Import check failed: {failure}")
+    if failures:
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
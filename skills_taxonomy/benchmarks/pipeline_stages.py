@@ -0,0 +1,358 @@
+"""Benchmark each stage of the pipeline on synthetic skills
+
+Synthetic skill descriptions, embeddings, classes and subclasses are generated
+for each corpus size, so that each stage is benchmarked in isolation from the
+stages before it. Clustering and sub clustering use the micro cluster ward
+backend, as agglomerative clustering of every skill does not fit in memory at
+the larger sizes. Embedding is benchmarked with a small sentence transformer
+model if one is given, otherwise with StandInEncoder, a tiny numpy encoder
+that tokenizes and pads batches like a sentence transformer. Each stage is timed, then run again with tracemalloc to find
+its peak memory, as tracing slows down the timed run. A stage that fails, for
+example by running out of memory, is recorded with its error.
+
+The results are saved as json after each size, and compared to a baseline
+results file, flagging the stages which are slower or use more memory than the
+baseline by more than a tolerance.
+
+Usage:
+    python skills_taxonomy/benchmarks/pipeline_stages.py [--sizes 10000 --sizes 100000]
+        [--model PATH_TO_SMALL_MODEL] [--baseline BASELINE_JSON]
+"""
+from pathlib import Path
+import platform
+import time
+import tracemalloc
+from typing import List, Optional
+import zlib
+import numpy as np
+import pandas as pd
+import typer
+from skills_taxonomy import config, logger, PROJECT_DIR
+from skills_taxonomy.analysis import tree as taxonomy_tree
+from skills_taxonomy.pipeline.add_labels import map_lbls_id
+from skills_taxonomy.pipeline.clustering import cluster, full_sub_cluster_assignment
+from skills_taxonomy.pipeline.embedding import encode_corpus, load_sentence_transformer
+from skills_taxonomy.pipeline.informative_words import count_terms, view_top_n_words
+from skills_taxonomy.pipeline.preprocessing import filter_skills
+from skills_taxonomy.utils.json_management import load_json, save_json
+
+VOCABULARY_SIZE = 20_000
+# increases smaller than these are timing noise rather than regressions
+MIN_REGRESSIONS = {"seconds": 0.1, "peak_memory_mb": 1}
+
+
+def synthetic_skills(n_rows, n_classes=9, n_subclasses=5, seed=0):
+    """Create synthetic raw skills with descriptions of 1 to 30 words drawn
+    from a Zipf distributed vocabulary, and class and subclass ids
+
+    Args:
+        n_rows (int): number of skills
+        n_classes (int): number of classes
+        n_subclasses (int): number of subclasses in each class
+        seed (int): random seed
+
+    Returns:
+        df: synthetic skills
+    """
+    rng = np.random.default_rng(seed)
+    n_words = rng.integers(1, 31, n_rows)
+    word_ids = (rng.zipf(1.3, n_words.sum()) - 1) % VOCABULARY_SIZE
+    words = np.array([f"word{i}" for i in range(VOCABULARY_SIZE)])[word_ids]
+    descriptions = [
+        " ".join(description)
+        for description in np.split(words, np.cumsum(n_words)[:-1])
+    ]
+    class_ids = rng.integers(0, n_classes, n_rows)
+    return pd.DataFrame(
+        {
+            "preferredLabel": [f"skill {i}" for i in range(n_rows)],
+            "altLabels": "",
+            "description": descriptions,
+            "class_id": class_ids,
+            "subclass_id": class_ids + rng.integers(0, n_subclasses, n_rows) / 10,
+        }
+    )
+
+
+def synthetic_embedding(class_ids, dim=768, seed=0):
+    """Create a synthetic embedding with a gaussian blob for each class
+
+    Args:
+        class_ids (array): class of each skill
+        dim (int): number of dimensions
+        seed (int): random seed
+
+    Returns:
+        array: float32 embedding
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((class_ids.max() + 1, dim), dtype=np.float32) * 2
+    return centres[class_ids] + rng.standard_normal(
+        (len(class_ids), dim), dtype=np.float32
+    )
+
+
+class StandInEncoder:
+    """Tiny numpy encoder standing in for a sentence transformer, so the embed
+    stage is benchmarked without a model. Words are hashed to token ids, then
+    each padded batch is embedded, passed through a dense layer and mean pooled
+    over its tokens.
+
+    Args:
+        dim (int): number of dimensions of the embedding
+        max_seq_length (int): number of tokens texts are truncated to
+        seed (int): random seed of the weights
+    """
+
+    def __init__(self, dim=64, max_seq_length=128, seed=0):
+        rng = np.random.default_rng(seed)
+        self.max_seq_length = max_seq_length
+        self.token_embeddings = rng.standard_normal(
+            (VOCABULARY_SIZE, dim), dtype=np.float32
+        )
+        self.weights = rng.standard_normal((dim, dim), dtype=np.float32) / dim**0.5
+
+    def tokenizer(self, texts, truncation=True, max_length=None, **kwargs):
+        """Split texts into words and hash them to token ids"""
+        max_length = max_length if truncation else None
+        return {
+            "input_ids": [
+                [
+                    zlib.crc32(word.encode()) % VOCABULARY_SIZE
+                    for word in text.split()[:max_length]
+                ]
+                for text in texts
+            ]
+        }
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, **kwargs):
+        """Encode texts to mean pooled embeddings
+
+        Args:
+            sentences (list of strs): texts to encode
+            batch_size (int): number of texts to encode at once
+            show_progress_bar (bool): unused, for compatibility with
+                SentenceTransformer.encode
+
+        Returns:
+            array: float32 embedding of sentences
+        """
+        input_ids = self.tokenizer(sentences, max_length=self.max_seq_length)[
+            "input_ids"
+        ]
+        embedding = np.zeros((len(sentences), self.weights.shape[1]), np.float32)
+        for start in range(0, len(sentences), batch_size):
+            batch = input_ids[start : start + batch_size]
+            padded = np.zeros((len(batch), max(map(len, batch), default=0)), int)
+            mask = np.zeros(padded.shape, np.float32)
+            for i, ids in enumerate(batch):
+                padded[i, : len(ids)] = ids
+                mask[i, : len(ids)] = 1
+            hidden = np.tanh(self.token_embeddings[padded] @ self.weights)
+            embedding[start : start + batch_size] = (hidden * mask[:, :, None]).sum(
+                axis=1
+            ) / np.maximum(mask.sum(axis=1, keepdims=True), 1)
+        return embedding
+
+
+def label_lookups(skills):
+    """Create class and subclass label lookups like the named classes json files"""
+    class_lbls = {str(i): f"class {i}" for i in np.unique(skills["class_id"])}
+    subclass_lbls = {str(i): f"subclass {i}" for i in np.unique(skills["subclass_id"])}
+    return class_lbls, subclass_lbls
+
+
+def label_skills(skills):
+    """Add class and subclass labels to skills"""
+    class_lbls, subclass_lbls = label_lookups(skills)
+    map_lbls_id(skills, label="class_lbl", id="class_id", lookup=class_lbls)
+    return map_lbls_id(
+        skills, label="subclass_lbl", id="subclass_id", lookup=subclass_lbls
+    )
+
+
+def make_tree(skills):
+    """Make the skills taxonomy index of class and subclass nodes"""
+    class_lbls, subclass_lbls = label_lookups(skills)
+    return taxonomy_tree.build_taxonomy_index(
+        skills["class_id"].to_numpy(),
+        skills["subclass_id"].to_numpy(),
+        {int(key): value for key, value in class_lbls.items()},
+        {float(key): value for key, value in subclass_lbls.items()},
+    )
+
+
+def class_top_words(skills):
+    """Find the most informative words of each class and subclass"""
+    term_counts, count = count_terms(skills["description"].values)
+    return [
+        view_top_n_words(skills, class_level, term_counts=term_counts, count=count)
+        for class_level in ["class_id", "subclass_id"]
+    ]
+
+
+def pipeline_stages(skills, embedding, n_classes, model=None):
+    """Create the stages to benchmark as functions of no arguments
+
+    Args:
+        skills (df): synthetic skills
+        embedding (array): synthetic embedding
+        n_classes (int): number of classes
+        model (str, optional): name or path of a sentence transformer model,
+            if None the embed stage is benchmarked with StandInEncoder
+
+    Returns:
+        dict: stage names and functions
+    """
+    embedder = StandInEncoder() if model is None else load_sentence_transformer(model)
+    descriptions = list(skills["description"].values)
+    return {
+        "embed": lambda: encode_corpus(embedder, descriptions),
+        "preprocess": lambda: filter_skills(skills),
+        "cluster": lambda: cluster(
+            embedding,
+            n_clusters=n_classes,
+            distance_threshold=None,
+            backend="micro_cluster_ward",
+        ),
+        "sub_cluster": lambda: full_sub_cluster_assignment(
+            embedding,
+            skills["class_id"].to_numpy(),
+            n_classes,
+            distances=[config["clustering"]["sub_clustering_distances"][0]] * n_classes,
+            n_jobs=1,
+            backend="micro_cluster_ward",
+        ),
+        "c_tf_idf": lambda: class_top_words(skills),
+        "label": lambda: label_skills(skills.copy()),
+        "tree": lambda: make_tree(skills),
+    }
+
+
+def benchmark_stage(stage, n_rows):
+    """Time a stage, then find its peak traced memory
+
+    Args:
+        stage (callable): stage function
+        n_rows (int): number of skills the stage processes
+
+    Returns:
+        dict: seconds, rows_per_sec and peak_memory_mb of the stage,
+            or its error if it failed
+    """
+    try:
+        start_time = time.perf_counter()
+        stage()
+        seconds = time.perf_counter() - start_time
+        tracemalloc.start()
+        try:
+            stage()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    except Exception as error:
+        return {"error": repr(error)}
+    return {
+        "seconds": seconds,
+        "rows_per_sec": n_rows / seconds,
+        "peak_memory_mb": peak_memory / 2**20,
+    }
+
+
+def benchmark_pipeline_stages(sizes, dim=768, n_classes=9, model=None):
+    """Benchmark each pipeline stage on synthetic skills of each size
+
+    Args:
+        sizes (list of ints): numbers of skills
+        dim (int): number of dimensions of the synthetic embedding
+        n_classes (int): number of classes
+        model (str, optional): sentence transformer model for the embed stage,
+            if None StandInEncoder is used
+
+    Yields:
+        str: size
+        dict: results for each stage at that size
+    """
+    for n_rows in sizes:
+        skills = synthetic_skills(n_rows, n_classes)
+        embedding = synthetic_embedding(skills["class_id"].to_numpy(), dim)
+        results = {}
+        for name, stage in pipeline_stages(skills, embedding, n_classes, model).items():
+            results[name] = benchmark_stage(stage, n_rows)
+            logger.info(f"{n_rows} rows, {name}: {results[name]}")
+        yield str(n_rows), results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """Find the stages which are slower or use more memory than the baseline
+    by more than the tolerance, ignoring increases smaller than MIN_REGRESSIONS
+
+    Args:
+        results (dict): benchmark results
+        baseline (dict): baseline benchmark results
+        tolerance (float): allowed fractional increase over the baseline
+
+    Returns:
+        list of strs: descriptions of the regressions
+    """
+    regressions = []
+    for size, stages in results.items():
+        for name, result in stages.items():
+            base = baseline.get(size, {}).get(name)
+            if base is None or "error" in base:
+                continue
+            if "error" in result:
+                regressions.append(
+                    f"{size} rows, {name}: failed with {result['error']}"
+                )
+                continue
+            for metric, min_regression in MIN_REGRESSIONS.items():
+                increase = result[metric] - base[metric]
+                if increase > base[metric] * tolerance and increase > min_regression:
+                    regressions.append(
+                        f"{size} rows, {name}: {metric} {result[metric]:.2f} "
+                        f"vs baseline {base[metric]:.2f}"
+                    )
+    return regressions
+
+
+app = typer.Typer()
+
+
+@app.command()
+def run(
+    sizes: List[int] = typer.Option([10_000, 100_000, 1_000_000]),
+    dim: int = 768,
+    model: Optional[str] = typer.Option(
+        None,
+        help="Small local sentence transformer model to benchmark embedding, "
+        "if not given a stand in numpy encoder is used",
+    ),
+    baseline: Optional[Path] = typer.Option(None, help="Baseline results json"),
+    tolerance: float = 0.2,
+    save_dir: Path = PROJECT_DIR / "outputs/benchmarks",
+):
+    """Benchmark the pipeline stages, save the results and flag regressions.
+    The results are saved after each size, so they are kept if a larger size fails"""
+    results = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "dim": dim,
+        "embed_model": model or "StandInEncoder",
+        "results": {},
+    }
+    for size, size_results in benchmark_pipeline_stages(sizes, dim, model=model):
+        results["results"][size] = size_results
+        save_json(f"{save_dir}/", "pipeline_stages.json", results)
+    if baseline is not None:
+        regressions = compare_to_baseline(
+            results["results"], load_json(baseline)["results"], tolerance
+        )
+        for regression in regressions:
+            logger.warning(f"Regression: {regression}")
+        if regressions:
+            raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,86 @@
+"""Micro benchmark of the per class overhead of sub clustering
+
+Times selecting each class's sub embedding, creating its sub cluster assignments
+and scattering them back into the full assignments, without fitting the
+clustering models, for the original python loops and the vectorised functions
+in skills_taxonomy.pipeline.clustering.
+"""
+import numpy as np
+import time
+from skills_taxonomy import logger
+from skills_taxonomy.pipeline.clustering import (
+    find_indices,
+    find_sub_embeddings,
+    sub_cluster_assignment,
+)
+
+
+def loop_sub_cluster_overhead(embedding, cluster_assignments, sub_cluster_labels):
+    """Sub clustering overhead using the original python loops"""
+    full_sub_cluster_assignments = np.empty(shape=(len(embedding),))
+    for class_id, labels in enumerate(sub_cluster_labels):
+        indices = np.squeeze(np.argwhere(cluster_assignments == class_id))
+        np.asarray([embedding[i] for i in indices])
+        assignments = np.asarray([(class_id + c / 10) for c in labels])
+        for i, a in zip(indices, assignments):
+            full_sub_cluster_assignments[i] = a
+    return full_sub_cluster_assignments
+
+
+def vectorised_sub_cluster_overhead(embedding, cluster_assignments, sub_cluster_labels):
+    """Sub clustering overhead using the vectorised clustering functions"""
+    class_indices = [
+        find_indices(cluster_assignments, class_id)
+        for class_id in range(len(sub_cluster_labels))
+    ]
+    for indices in class_indices:
+        find_sub_embeddings(embedding, indices)
+    full_sub_cluster_assignments = np.empty(shape=(len(embedding),))
+    full_sub_cluster_assignments[np.concatenate(class_indices)] = np.concatenate(
+        [
+            sub_cluster_assignment(labels, class_id)
+            for class_id, labels in enumerate(sub_cluster_labels)
+        ]
+    )
+    return full_sub_cluster_assignments
+
+
+def benchmark_sub_cluster_overhead(n_rows=1_000_000, dim=768, n_classes=9):
+    """Time the loop and vectorised sub clustering overhead on a
+    synthetic embedding with random class and sub class labels
+
+    Args:
+        n_rows (int): number of skills in the synthetic embedding
+        dim (int): number of dimensions of the synthetic embedding
+        n_classes (int): number of classes
+
+    Returns:
+        dict: seconds per class for the loop and vectorised implementations
+    """
+    rng = np.random.default_rng(0)
+    embedding = rng.standard_normal((n_rows, dim), dtype=np.float32)
+    cluster_assignments = rng.integers(0, n_classes, n_rows)
+    sub_cluster_labels = [
+        rng.integers(0, 9, (cluster_assignments == class_id).sum())
+        for class_id in range(n_classes)
+    ]
+    timings = {}
+    results = {}
+    for name, overhead in [
+        ("loop", loop_sub_cluster_overhead),
+        ("vectorised", vectorised_sub_cluster_overhead),
+    ]:
+        start_time = time.perf_counter()
+        results[name] = overhead(embedding, cluster_assignments, sub_cluster_labels)
+        timings[name] = (time.perf_counter() - start_time) / n_classes
+    assert np.array_equal(results["loop"], results["vectorised"])
+    return timings
+
+
+if __name__ == "__main__":
+    timings = benchmark_sub_cluster_overhead()
+    logger.info(
+        f"Sub clustering overhead per class: loop {timings['loop']:.3f}s, "
+        f"vectorised {timings['vectorised']:.3f}s "
+        f"({timings['loop'] / timings['vectorised']:.1f}x faster)"
+    )
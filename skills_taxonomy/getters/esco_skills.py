@@ -3,7 +3,10 @@
 Data source: https://ec.europa.eu/esco/portal
 """
 import pandas as pd
-from skills_taxonomy import PROJECT_DIR, logger
+from skills_taxonomy import config, PROJECT_DIR, logger
+
+# Columns of the skills data used by the pipeline
+SKILLS_COLUMNS = ["preferredLabel", "altLabels", "description"]
 
 
 def get_skills() -> pd.DataFrame:
@@ -15,10 +18,58 @@ def get_skills() -> pd.DataFrame:
     return pd.read_csv(f"{PROJECT_DIR}/inputs/data/skills_en.csv")
 
 
+def get_skills_chunks(
+    skills_path=f"{PROJECT_DIR}/inputs/data/skills_en.csv",
+    chunksize=config["skills"]["chunksize"],
+    columns=SKILLS_COLUMNS,
+):
+    """Load skills in chunks, only reading the columns used by the pipeline
+
+    Args:
+        skills_path (str): path to skills csv,
+            defaults to f"{PROJECT_DIR}/inputs/data/skills_en.csv"
+        chunksize (int): number of rows in each chunk
+        columns (list of strs or None): columns to read, defaults to SKILLS_COLUMNS,
+            if None all columns are read
+
+    Returns:
+        iterator of dfs: chunks of skills
+    """
+    return pd.read_csv(skills_path, usecols=columns, chunksize=chunksize)
+
+
+def get_output_skills_chunks(skills_path, chunksize=config["skills"]["chunksize"]):
+    """Load skills saved by the pipeline in chunks
+
+    Args:
+        skills_path (str): path to skills csv saved by the pipeline
+        chunksize (int): number of rows in each chunk
+
+    Returns:
+        iterator of dfs: chunks of skills
+    """
+    return pd.read_csv(skills_path, index_col=[0], chunksize=chunksize)
+
+
 def get_output_skills(
-    skills_path=f"{PROJECT_DIR}/outputs/skills/labelled_skills.csv",
+    skills_path=f"{PROJECT_DIR}/outputs/skills/labelled_skills.parquet",
+    columns=None,
 ) -> pd.DataFrame:
+    """Load skills saved by the pipeline, from parquet or csv
+
+    Args:
+        skills_path (str): path to skills parquet or csv file,
+            defaults to f"{PROJECT_DIR}/outputs/skills/labelled_skills.parquet"
+        columns (list of strs, optional): columns to read, defaults to all columns.
+            Only these columns are read from a parquet file.
+
+    Returns:
+        df: skills
+    """
     try:
-        return pd.read_csv(skills_path, index_col=[0])
+        if str(skills_path).endswith(".parquet"):
+            return pd.read_parquet(skills_path, columns=columns)
+        skills = pd.read_csv(skills_path, index_col=[0])
+        return skills if columns is None else skills[columns]
     except FileNotFoundError:
         logger.error(f"There is no file to read at {skills_path}")
@@ -1,4 +1,5 @@
 from skills_taxonomy.utils.json_management import load_json
+from skills_taxonomy.utils.instrumentation import instrument
 from skills_taxonomy import PROJECT_DIR
 
 
@@ -12,16 +13,18 @@ def map_lbls_id(skills, label, id, lookup):
         lookup (dict): to use for mapping - keys of ids, values of labels
 
     Returns:
-        df: skills dataframe with additional class label column
+        df: skills dataframe with additional class label column, stored as
+            a categorical so each label string is only stored once
     """
-    skills[label] = skills[id].astype(str).map(lookup)
-    if label == "class_id":
+    skills[label] = skills[id].astype(str).map(lookup).astype("category")
+    if id == "class_id":
         skills[id] = skills[id].astype(int)
-    if label == "subclass_id":
+    if id == "subclass_id":
         skills[id] = skills[id].astype(float)
     return skills
 
 
+@instrument
 def add_labels(skills):
     """Add 'class_lbl' and 'subclass_lbl' cols to skills dataframe
 
@@ -0,0 +1,97 @@
+"""Exact k most similar skills for every skill in the embedding.
+
+The normalised embedding is multiplied by its transpose a block of rows at a
+time, so only a block_rows x n_rows matrix of cosine similarities exists at
+once rather than the full n_rows x n_rows matrix. The number of rows in a block
+is set by a memory budget for the block's similarities and the buffers made
+when finding the most similar skills in them. The results are written
+to .npy memory maps as they are found, as int32 skill indices and float16
+cosine similarities.
+"""
+import numpy as np
+from skills_taxonomy import config, logger, PROJECT_DIR
+from skills_taxonomy.pipeline.ann_index import top_k
+from skills_taxonomy.pipeline.clustering import normalise_embedding
+from skills_taxonomy.utils.dir_management import make_dir_if_not_exist
+
+# each pair in a block has a float32 similarity, and top_k makes a float32
+# negated copy of the similarities and an int64 argpartition of them
+BLOCK_BYTES_PER_PAIR = 4 + 4 + 8
+
+
+def rows_per_block(n_rows, memory_budget_mb):
+    """Find the number of rows whose similarities to all n_rows skills,
+    and the buffers top_k makes of them, fit in the memory budget
+
+    Args:
+        n_rows (int): number of skills
+        memory_budget_mb (float): memory budget of a block in megabytes
+
+    Returns:
+        int: number of rows in a block, at least 1
+    """
+    return max(1, int(memory_budget_mb * 2**20) // (BLOCK_BYTES_PER_PAIR * n_rows))
+
+
+def all_pairs_top_k(
+    embedding,
+    save_dir=PROJECT_DIR / "outputs/models/all_pairs",
+    k=config["all_pairs"]["k"],
+    memory_budget_mb=config["all_pairs"]["memory_budget_mb"],
+):
+    """Find the k most similar skills to every skill by cosine similarity,
+    excluding the skill itself, and save them as neighbours.npy and
+    similarities.npy
+
+    Args:
+        embedding (array): skills embedding
+        save_dir (Path, optional): directory to save the results,
+                            defaults to PROJECT_DIR/"outputs/models/all_pairs"
+        k (int, optional): number of similar skills to find for each skill
+        memory_budget_mb (float, optional): memory budget for the cosine
+            similarities of a block of rows and their top_k buffers in megabytes
+
+    Returns:
+        array: int32 indices of the k most similar skills to each skill,
+            most similar first
+        array: float16 cosine similarities of the k most similar skills
+    """
+    n_rows = len(embedding)
+    k = min(k, n_rows - 1)
+    normalised = normalise_embedding(np.asarray(embedding, dtype=np.float32))
+    make_dir_if_not_exist(save_dir)
+    neighbours = np.lib.format.open_memmap(
+        save_dir / "neighbours.npy", mode="w+", dtype=np.int32, shape=(n_rows, k)
+    )
+    similarities = np.lib.format.open_memmap(
+        save_dir / "similarities.npy", mode="w+", dtype=np.float16, shape=(n_rows, k)
+    )
+    block_rows = rows_per_block(n_rows, memory_budget_mb)
+    logger.info(f"Finding top {k} similar skills in blocks of {block_rows} rows")
+    for start in range(0, n_rows, block_rows):
+        stop = min(start + block_rows, n_rows)
+        scores = normalised[start:stop] @ normalised.T
+        scores[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+        top = top_k(scores, k)
+        neighbours[start:stop] = top
+        similarities[start:stop] = np.take_along_axis(scores, top, axis=1)
+    neighbours.flush()
+    similarities.flush()
+    return neighbours, similarities
+
+
+def load_all_pairs_top_k(load_dir=PROJECT_DIR / "outputs/models/all_pairs"):
+    """Load the k most similar skills to every skill as memory maps
+
+    Args:
+        load_dir (Path, optional): directory the results were saved to,
+                            defaults to PROJECT_DIR/"outputs/models/all_pairs"
+
+    Returns:
+        array: int32 indices of the k most similar skills to each skill
+        array: float16 cosine similarities of the k most similar skills
+    """
+    return (
+        np.load(load_dir / "neighbours.npy", mmap_mode="r"),
+        np.load(load_dir / "similarities.npy", mmap_mode="r"),
+    )
@@ -0,0 +1,164 @@
+"""Approximate nearest neighbour index to find the skills most similar to a skill.
+
+The index is an inverted file index. The normalised embedding is partitioned
+into lists with mini batch k-means, and a query is only compared exactly to
+the skills in the n_probe lists whose centroids are most similar to it.
+Searching n_probe of n_lists lists compares a query to roughly n_probe / n_lists
+of the skills, rather than all of them.
+
+The index is saved as .npy files: the list centroids, the norm of each skill's
+embedding, and the skill indices in each list in compressed sparse row form
+(list_offsets and list_indices). Saved indexes are kept in a directory named
+with the fingerprint of the embedding they were built from.
+"""
+import numpy as np
+from skills_taxonomy import config, PROJECT_DIR
+from skills_taxonomy.pipeline.clustering import normalise_embedding
+from skills_taxonomy.utils.array_management import load_arrays, save_arrays
+from skills_taxonomy.utils.fingerprint import array_fingerprint
+
+ANN_INDEX_ARRAYS = ["centroids", "norms", "list_offsets", "list_indices"]
+
+
+def top_k(scores, k):
+    """Find the indices of the k highest scores in each row, highest first
+
+    Args:
+        scores (array): 2 dimensional array of scores
+        k (int): number of scores to find
+
+    Returns:
+        array: indices of the k highest scores in each row
+    """
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def build_ann_index(embedding, n_lists=config["ann_index"]["n_lists"]):
+    """Build an inverted file index of the embedding
+
+    Args:
+        embedding (array): skills embedding
+        n_lists (int or None, optional): number of lists to partition the skills
+            into, if None the square root of the number of skills is used
+
+    Returns:
+        dict: arrays of the index, with keys ANN_INDEX_ARRAYS
+    """
+    from sklearn.cluster import MiniBatchKMeans
+
+    if n_lists is None:
+        n_lists = max(1, int(np.sqrt(len(embedding))))
+    kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=0).fit(
+        normalise_embedding(embedding)
+    )
+    list_sizes = np.bincount(kmeans.labels_, minlength=n_lists)
+    return {
+        "centroids": normalise_embedding(kmeans.cluster_centers_).astype(np.float32),
+        "norms": np.linalg.norm(embedding, axis=1).astype(np.float32),
+        "list_offsets": np.concatenate([[0], np.cumsum(list_sizes)]),
+        "list_indices": np.argsort(kmeans.labels_, kind="stable").astype(np.int32),
+    }
+
+
+def save_ann_index(index, save_dir=PROJECT_DIR / "outputs/models/ann_index"):
+    """Save the arrays of an index as .npy files
+
+    Args:
+        index (dict): arrays of the index
+        save_dir (Path, optional): directory to save the index,
+                            defaults to PROJECT_DIR/"outputs/models/ann_index"
+    """
+    save_arrays(index, ANN_INDEX_ARRAYS, save_dir)
+
+
+def load_ann_index(load_dir=PROJECT_DIR / "outputs/models/ann_index"):
+    """Load the arrays of an index as memory maps
+
+    Args:
+        load_dir (Path, optional): directory the index was saved to,
+                            defaults to PROJECT_DIR/"outputs/models/ann_index"
+
+    Returns:
+        dict: arrays of the index
+    """
+    return load_arrays(ANN_INDEX_ARRAYS, load_dir)
+
+
+def load_or_build_ann_index(
+    embedding, index_dir=PROJECT_DIR / "outputs/models/ann_index"
+):
+    """Load the index of the embedding, building and saving it if it does not exist.
+    Indexes are saved in a directory named with the fingerprint of the embedding
+    they were built from, so an index is never used with a different embedding.
+
+    Args:
+        embedding (array): skills embedding
+        index_dir (Path, optional): directory of saved indexes,
+                            defaults to PROJECT_DIR/"outputs/models/ann_index"
+
+    Returns:
+        dict: arrays of the index
+    """
+    embedding_index_dir = index_dir / array_fingerprint(embedding)
+    if not (embedding_index_dir / "centroids.npy").exists():
+        save_ann_index(build_ann_index(embedding), embedding_index_dir)
+    return load_ann_index(embedding_index_dir)
+
+
+def query_ann_index(
+    index, embedding, queries, k=10, n_probe=config["ann_index"]["n_probe"]
+):
+    """Find the approximate k most similar skills by cosine similarity
+    for each of a batch of query embeddings
+
+    Args:
+        index (dict): arrays of the index
+        embedding (array): skills embedding the index was built from
+        queries (array): 2 dimensional array of query embeddings
+        k (int): number of similar skills to find, defaults to 10
+        n_probe (int, optional): number of lists to search for each query
+
+    Returns:
+        array: indices of the k most similar skills to each query, most similar first
+        array: cosine similarities of the k most similar skills to each query
+    """
+    queries = normalise_embedding(np.atleast_2d(queries))
+    probes = top_k(queries @ index["centroids"].T, n_probe)
+    offsets = index["list_offsets"]
+    neighbours = np.zeros((len(queries), k), dtype=np.int32)
+    similarities = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    for i, (query, lists) in enumerate(zip(queries, probes)):
+        candidates = np.concatenate(
+            [index["list_indices"][offsets[j] : offsets[j + 1]] for j in lists]
+        )
+        scores = embedding[candidates] @ query / index["norms"][candidates]
+        top = top_k(scores[None, :], k)[0]
+        neighbours[i, : len(top)] = candidates[top]
+        similarities[i, : len(top)] = scores[top]
+    return neighbours, similarities
+
+
+def recall_at_k(index, embedding, query_indices, k=10, **query_kwargs):
+    """Find the fraction of the exact k most similar skills that the index finds
+
+    Args:
+        index (dict): arrays of the index
+        embedding (array): skills embedding the index was built from
+        query_indices (array): indices of skills to use as queries
+        k (int): number of similar skills to compare, defaults to 10
+        query_kwargs: keyword arguments for query_ann_index
+
+    Returns:
+        float: mean recall at k over the queries
+    """
+    normalised = normalise_embedding(embedding)
+    exact = top_k(normalised[query_indices] @ normalised.T, k)
+    approximate, _ = query_ann_index(
+        index, embedding, embedding[query_indices], k=k, **query_kwargs
+    )
+    return float(
+        np.mean([len(np.intersect1d(e, a)) / k for e, a in zip(exact, approximate)])
+    )
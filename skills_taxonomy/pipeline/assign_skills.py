@@ -0,0 +1,269 @@
+"""Assign new skills to the existing classes and subclasses without re-clustering.
+
+Re-clustering to place new skills would change the class and subclass ids, and
+so lose the hand checked names of the classes. Instead the centroid of each
+subclass of the clustered skills is saved, along with a radius: a quantile of
+the cosine distances of the subclass's skills to its centroid. A new skill is
+assigned the class_id and subclass_id of either its most similar centroid, or
+the subclass with the highest similarity weighted vote among its k most
+similar skills in the nearest neighbour index. A new skill further from its
+subclass centroid than the subclass radius is flagged as novel, as it may
+belong to a class which is not in the taxonomy yet.
+
+The saved centroids are never updated by assignment, so assigning the same
+skill always gives the same ids, and the class and subclass labels stay valid.
+
+New skills are read from one text column of a csv, description by default,
+and every row is assigned, however short its text.
+
+Usage:
+    python skills_taxonomy/pipeline/assign_skills.py NEW_SKILLS_CSV SAVE_CSV
+        [--text-column COLUMN]
+"""
+from pathlib import Path
+import numpy as np
+from scipy import sparse
+import typer
+from skills_taxonomy import config, PROJECT_DIR
+from skills_taxonomy.getters.esco_skills import get_output_skills, get_skills_chunks
+from skills_taxonomy.pipeline.add_labels import add_labels
+from skills_taxonomy.pipeline.ann_index import load_or_build_ann_index, query_ann_index
+from skills_taxonomy.pipeline.clustering import normalise_embedding
+from skills_taxonomy.pipeline.embedding import (
+    EmbeddingCache,
+    create_embedding,
+    embedding_cache_dir,
+    load_embedding,
+    load_sentence_transformer,
+)
+from skills_taxonomy.utils.array_management import load_arrays, save_arrays
+from skills_taxonomy.utils.dir_management import make_dir_if_not_exist
+
+CENTROID_ARRAYS = ["centroids", "class_ids", "subclass_ids", "radii"]
+
+
+def subclass_centroids(
+    skills, embedding, novelty_quantile=config["assignment"]["novelty_quantile"]
+):
+    """Find the centroid and radius of each subclass of the clustered skills
+
+    Args:
+        skills (df): clustered skills, with class_id and subclass_id columns,
+            in the same order as the embedding
+        embedding (array): skills embedding
+        novelty_quantile (float, optional): quantile of the cosine distances of
+            a subclass's skills to its centroid to use as the subclass radius
+
+    Returns:
+        dict: arrays with a row for each subclass, with keys CENTROID_ARRAYS
+    """
+    embedding = normalise_embedding(embedding)
+    subclass_ids, subclass_index = np.unique(
+        skills["subclass_id"].to_numpy(), return_inverse=True
+    )
+    indicator = sparse.csr_matrix(
+        (np.ones(len(subclass_index)), (subclass_index, np.arange(len(embedding)))),
+        shape=(len(subclass_ids), len(embedding)),
+    )
+    centroids = normalise_embedding(indicator @ embedding)
+    distances = 1 - np.einsum("ij,ij->i", embedding, centroids[subclass_index])
+    order = np.argsort(subclass_index, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(subclass_index))])
+    radii = np.array(
+        [
+            np.quantile(distances[order[start:stop]], novelty_quantile)
+            for start, stop in zip(offsets[:-1], offsets[1:])
+        ]
+    )
+    class_ids = np.zeros(len(subclass_ids), dtype=int)
+    class_ids[subclass_index] = skills["class_id"].to_numpy()
+    return {
+        "centroids": centroids.astype(np.float32),
+        "class_ids": class_ids,
+        "subclass_ids": subclass_ids,
+        "radii": radii,
+    }
+
+
+def save_centroids(centroids, save_dir=PROJECT_DIR / "outputs/models/centroids"):
+    """Save the subclass centroid arrays as .npy files
+
+    Args:
+        centroids (dict): subclass centroid arrays
+        save_dir (Path, optional): directory to save the centroids,
+                            defaults to PROJECT_DIR/"outputs/models/centroids"
+    """
+    save_arrays(centroids, CENTROID_ARRAYS, save_dir)
+
+
+def load_centroids(load_dir=PROJECT_DIR / "outputs/models/centroids"):
+    """Load the subclass centroid arrays as memory maps
+
+    Args:
+        load_dir (Path, optional): directory the centroids were saved to,
+                            defaults to PROJECT_DIR/"outputs/models/centroids"
+
+    Returns:
+        dict: subclass centroid arrays
+    """
+    return load_arrays(CENTROID_ARRAYS, load_dir)
+
+
+def knn_vote(neighbour_subclasses, similarities, subclass_ids):
+    """Find the subclass with the highest total similarity among each
+    skill's nearest neighbours
+
+    Args:
+        neighbour_subclasses (array): subclass_id of each nearest neighbour,
+            with a row for each skill
+        similarities (array): cosine similarity of each nearest neighbour
+        subclass_ids (array): sorted unique subclass ids
+
+    Returns:
+        array: index into subclass_ids of the winning subclass of each skill
+    """
+    votes = np.zeros((len(neighbour_subclasses), len(subclass_ids)))
+    rows = np.repeat(
+        np.arange(len(neighbour_subclasses)), neighbour_subclasses.shape[1]
+    )
+    np.add.at(
+        votes,
+        (rows, np.searchsorted(subclass_ids, neighbour_subclasses.ravel())),
+        np.where(np.isfinite(similarities), similarities, 0).ravel(),
+    )
+    return votes.argmax(axis=1)
+
+
+def assign_embedding(
+    new_embedding,
+    centroids,
+    method=config["assignment"]["method"],
+    index=None,
+    embedding=None,
+    skill_subclass_ids=None,
+    k=config["assignment"]["k"],
+):
+    """Assign embedded new skills to the existing classes and subclasses
+
+    Args:
+        new_embedding (array): embedding of the new skills
+        centroids (dict): subclass centroid arrays
+        method (str, optional): 'centroid' to assign the most similar centroid's
+            subclass, or 'knn' for a vote of the k most similar clustered skills
+        index (dict): nearest neighbour index of the clustered skills, for 'knn'
+        embedding (array): embedding of the clustered skills, for 'knn'
+        skill_subclass_ids (array): subclass_id of each clustered skill, for 'knn'
+        k (int, optional): number of clustered skills that vote, for 'knn'
+
+    Returns:
+        dict: class_id, subclass_id, distance to the subclass centroid and
+            novel flag of each new skill
+    """
+    new_embedding = normalise_embedding(new_embedding)
+    similarities = new_embedding @ centroids["centroids"].T
+    if method == "centroid":
+        best = similarities.argmax(axis=1)
+    elif method == "knn":
+        neighbours, neighbour_similarities = query_ann_index(
+            index, embedding, new_embedding, k=k
+        )
+        best = knn_vote(
+            np.asarray(skill_subclass_ids)[neighbours],
+            neighbour_similarities,
+            centroids["subclass_ids"],
+        )
+    else:
+        raise ValueError(f"Unknown assignment method {method}")
+    distances = 1 - similarities[np.arange(len(best)), best]
+    return {
+        "class_id": centroids["class_ids"][best],
+        "subclass_id": centroids["subclass_ids"][best],
+        "centroid_distance": distances,
+        "novel": distances > centroids["radii"][best],
+    }
+
+
+def assign_skills_chunks(
+    skills_chunks,
+    centroids,
+    text_column=config["assignment"]["text_column"],
+    cache_dir=PROJECT_DIR / "outputs/models/new_skills_embedding_cache",
+    model_name=config["sentence_transformer"]["model"],
+    backend=config["sentence_transformer"]["backend"],
+    **assign_kwargs,
+):
+    """Embed and assign chunks of new skills to the existing classes and
+    subclasses, adding their labels. New skills, such as phrases from job
+    adverts, are often only a few words long, so no rows are filtered out.
+
+    The embedding cache and model are loaded once for all the chunks, and new
+    skills are cached separately from the clustered skills' embeddings.
+
+    Args:
+        skills_chunks (iterable of dfs): chunks of new skills
+        centroids (dict): subclass centroid arrays
+        text_column (str, optional): column of the text to embed for each skill
+        cache_dir (Path, optional): root directory of the new skills embedding cache,
+            defaults to PROJECT_DIR/"outputs/models/new_skills_embedding_cache"
+        model_name (str, optional): name of the sentence transformer model
+        backend (str, optional): backend to run the model with, 'torch' or 'onnx'
+        assign_kwargs: keyword arguments for assign_embedding
+
+    Yields:
+        df: chunk of new skills with class and subclass ids and labels,
+            centroid_distance and novel columns
+    """
+    embedding_cache = EmbeddingCache(
+        embedding_cache_dir(model_name, cache_dir, backend)
+    )
+    embedder = load_sentence_transformer(model_name, backend)
+    for skills in skills_chunks:
+        texts = skills[text_column].fillna("").astype(str)
+        embedding = create_embedding(
+            texts.to_frame("description"),
+            model_name=model_name,
+            backend=backend,
+            embedding_cache=embedding_cache,
+            embedder=embedder,
+        )
+        assignments = assign_embedding(embedding, centroids, **assign_kwargs)
+        yield add_labels(skills.assign(**assignments))
+
+
+app = typer.Typer()
+
+
+@app.command()
+def assign(
+    skills_path: Path,
+    save_path: Path,
+    text_column: str = typer.Option(
+        config["assignment"]["text_column"],
+        help="Column of the skills csv containing the text to embed",
+    ),
+):
+    """Assign the skills in a csv to the existing classes and subclasses in chunks,
+    saving them with their ids, labels and novel flags to a csv"""
+    assign_kwargs = {}
+    if config["assignment"]["method"] == "knn":
+        embedding = load_embedding()
+        assign_kwargs = {
+            "index": load_or_build_ann_index(embedding),
+            "embedding": embedding,
+            "skill_subclass_ids": get_output_skills(columns=["subclass_id"])[
+                "subclass_id"
+            ].to_numpy(),
+        }
+    make_dir_if_not_exist(save_path.parent)
+    chunks = assign_skills_chunks(
+        get_skills_chunks(skills_path, columns=None),
+        load_centroids(),
+        text_column=text_column,
+        **assign_kwargs,
+    )
+    for i, skills in enumerate(chunks):
+        skills.to_csv(save_path, mode="a" if i else "w", header=not i)
+
+
+if __name__ == "__main__":
+    app()
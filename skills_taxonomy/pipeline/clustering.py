@@ -3,10 +3,18 @@
 Agglomerative clustering is used to find skill classes and sub classes. The parameter distance_threshold influences the size of the clusters produced. A higher distance threshold results in fewer clusters.
 
 Firstly, agglomerative clustering is performed on the whole dataset to find high level skill classes. Then, agglomerative clustering is performed on each of these classes to create sub classes.
+
+Agglomerative clustering of every skill needs memory quadratic in the number of skills, so for larger datasets the clustering backend can be changed in the config to one restricted to a sparse nearest neighbours graph or one that merges micro clusters.
 """
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import numpy as np
-from skills_taxonomy import config
-from sklearn.cluster import AgglomerativeClustering
+import os
+from skills_taxonomy import config, PROJECT_DIR
+from skills_taxonomy.utils.dir_management import make_dir_if_not_exist
+from skills_taxonomy.utils.fingerprint import array_fingerprint
+from skills_taxonomy.utils.instrumentation import instrument
+import tempfile
 
 
 def normalise_embedding(embedding):
@@ -21,14 +29,309 @@ def normalise_embedding(embedding):
     return embedding / np.linalg.norm(embedding, axis=1, keepdims=True)
 
 
+def weighted_ward_merges(centroids, weights):
+    """Find the Ward linkage merges between weighted points using the
+    nearest neighbour chain algorithm. A point with weight n behaves as a
+    cluster of n identical points, so this is Ward linkage over the original
+    points with each group of points held together.
+
+    Args:
+        centroids (array): points to merge
+        weights (array): number of original points each centroid represents
+
+    Returns:
+        array: one row per merge of (cluster a, cluster b, linkage distance),
+            the merged cluster keeps the index a. Merges are not sorted by distance.
+    """
+    sizes = np.asarray(weights, dtype=float).copy()
+    squared_norms = (centroids**2).sum(axis=1)
+    squared_distances = np.maximum(
+        squared_norms[:, None] + squared_norms[None, :] - 2 * centroids @ centroids.T,
+        0,
+    )
+    # scipy/sklearn define Ward distance as sqrt(2 n_a n_b / (n_a + n_b)) * ||c_a - c_b||
+    ward = 2 * squared_distances * np.outer(sizes, sizes) / np.add.outer(sizes, sizes)
+    np.fill_diagonal(ward, np.inf)
+
+    merges = []
+    chain = []
+    active = np.ones(len(centroids), dtype=bool)
+    while active.sum() > 1:
+        if not chain:
+            chain.append(int(np.flatnonzero(active)[0]))
+        a = chain[-1]
+        b = int(np.argmin(ward[a]))
+        if len(chain) > 1 and ward[a, chain[-2]] <= ward[a, b]:
+            b = chain[-2]
+        if len(chain) > 1 and b == chain[-2]:
+            chain = chain[:-2]
+            merges.append((a, b, np.sqrt(ward[a, b])))
+            # Lance-Williams update of the squared Ward distances to the merged cluster
+            updated = (
+                (sizes + sizes[a]) * ward[a]
+                + (sizes + sizes[b]) * ward[b]
+                - sizes * ward[a, b]
+            ) / (sizes + sizes[a] + sizes[b])
+            sizes[a] += sizes[b]
+            ward[a, :] = updated
+            ward[:, a] = updated
+            ward[b, :] = np.inf
+            ward[:, b] = np.inf
+            ward[a, a] = np.inf
+            active[b] = False
+        else:
+            chain.append(b)
+    return np.asarray(merges).reshape(-1, 3)
+
+
+def cut_merges(n_points, merges, n_clusters=None, distance_threshold=None):
+    """Assign points to clusters by applying the merges of a linkage
+    below a distance threshold, or the smallest merges until n_clusters remain
+
+    Args:
+        n_points (int): number of points that were merged
+        merges (array): one row per merge of (cluster a, cluster b, linkage distance)
+        n_clusters (int or None, optional): number of clusters to find.
+        distance_threshold (float or None, optional): linkage distance threshold
+                        above which, clusters will not be merged.
+
+    Returns:
+        array: cluster labels of each point, numbered from 0
+    """
+    merges = merges[np.argsort(merges[:, 2], kind="stable")]
+    if distance_threshold is not None:
+        merges = merges[merges[:, 2] < distance_threshold]
+    elif n_clusters > n_points:
+        raise ValueError(
+            f"Can not find {n_clusters} clusters of {n_points} points, "
+            "n_clusters must be at most the number of points"
+        )
+    else:
+        merges = merges[: n_points - n_clusters]
+    parents = np.arange(n_points)
+
+    def root(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for a, b, _ in merges:
+        parents[root(int(b))] = root(int(a))
+    roots = np.asarray([root(i) for i in range(n_points)])
+    return np.unique(roots, return_inverse=True)[1]
+
+
+class MicroClusterWard:
+    """Two stage clustering for embeddings too large for agglomerative
+    clustering. Mini batch k-means first groups the skills into micro clusters,
+    then weighted Ward linkage merges the micro clusters. Weighting each micro
+    cluster by its size keeps the linkage distances, and so distance_threshold,
+    on the same scale as Ward linkage over every skill.
+
+    Has the same labels_ and n_clusters_ attributes as AgglomerativeClustering.
+    """
+
+    def __init__(
+        self,
+        n_clusters=None,
+        distance_threshold=None,
+        n_micro_clusters=config["clustering"]["n_micro_clusters"],
+    ):
+        self.n_clusters = n_clusters
+        self.distance_threshold = distance_threshold
+        self.n_micro_clusters = n_micro_clusters
+
+    def fit(self, embedding):
+        """Fit micro clusters and merge them
+
+        Args:
+            embedding (array): skills embedding
+
+        Returns:
+            MicroClusterWard: fitted model
+        """
+        from sklearn.cluster import MiniBatchKMeans
+
+        if len(embedding) <= self.n_micro_clusters:
+            micro_labels = np.arange(len(embedding))
+            centroids = np.asarray(embedding, dtype=float)
+        else:
+            kmeans = MiniBatchKMeans(
+                n_clusters=self.n_micro_clusters, random_state=0
+            ).fit(embedding)
+            micro_labels = kmeans.labels_
+            centroids = kmeans.cluster_centers_
+        weights = np.bincount(micro_labels, minlength=len(centroids))
+        # drop micro clusters mini batch k-means left empty
+        occupied = np.flatnonzero(weights)
+        micro_labels = np.searchsorted(occupied, micro_labels)
+        centroids, weights = centroids[occupied], weights[occupied]
+
+        merges = weighted_ward_merges(centroids, weights)
+        centroid_labels = cut_merges(
+            len(centroids), merges, self.n_clusters, self.distance_threshold
+        )
+        self.labels_ = centroid_labels[micro_labels]
+        self.n_clusters_ = int(centroid_labels.max()) + 1
+        return self
+
+
+def compute_linkage(embedding, method="ward", metric="euclidean"):
+    """Compute the full hierarchical clustering linkage matrix
+
+    Args:
+        embedding (array): skills embedding
+        method (str, optional): linkage criteria to use.
+        metric (str, optional): metric used to compute the linkage.
+
+    Returns:
+        array: scipy linkage matrix, one row per merge of
+            (cluster a, cluster b, linkage distance, number of skills)
+    """
+    # imported here as importing scipy.cluster is slow
+    from scipy.cluster import hierarchy
+
+    return hierarchy.linkage(embedding, method=method, metric=metric)
+
+
+def load_or_compute_linkage(
+    embedding,
+    method="ward",
+    metric="euclidean",
+    linkage_dir=PROJECT_DIR / "outputs/models/linkage",
+):
+    """Load the linkage matrix for an embedding if it has been saved before,
+    otherwise compute and save it. Linkage matrices are saved with the
+    fingerprint of the embedding they were computed from in their file name.
+
+    Args:
+        embedding (array): skills embedding
+        method (str, optional): linkage criteria to use.
+        metric (str, optional): metric used to compute the linkage.
+        linkage_dir (Path, optional): directory of saved linkage matrices,
+                            defaults to PROJECT_DIR/"outputs/models/linkage"
+
+    Returns:
+        array: scipy linkage matrix
+    """
+    linkage_path = linkage_dir / f"{method}_{metric}_{array_fingerprint(embedding)}.npy"
+    if linkage_path.exists():
+        return np.load(linkage_path)
+    linkage_matrix = compute_linkage(embedding, method, metric)
+    make_dir_if_not_exist(linkage_dir)
+    np.save(linkage_path, linkage_matrix)
+    return linkage_matrix
+
+
+def cut_linkage(linkage_matrix, n_clusters=None, distance_threshold=None):
+    """Cut a linkage matrix into flat clusters
+
+    Args:
+        linkage_matrix (array): scipy linkage matrix
+        n_clusters (int or None, optional): number of clusters to find.
+        distance_threshold (float or None, optional): linkage distance threshold
+                        above which, clusters will not be merged.
+
+    Returns:
+        array: cluster labels of each skill, numbered from 0
+    """
+    from scipy.cluster import hierarchy
+
+    if distance_threshold is not None:
+        # fcluster merges up to and including the threshold, sklearn merges below it
+        labels = hierarchy.fcluster(
+            linkage_matrix,
+            t=np.nextafter(distance_threshold, -np.inf),
+            criterion="distance",
+        )
+    else:
+        labels = hierarchy.fcluster(linkage_matrix, t=n_clusters, criterion="maxclust")
+    return labels - 1
+
+
+def threshold_sweep(linkage_matrix, distance_thresholds):
+    """Find the number of clusters a linkage matrix is cut into at each of
+    several distance thresholds, without refitting
+
+    Args:
+        linkage_matrix (array): scipy linkage matrix of a monotonic linkage, such as ward
+        distance_thresholds (list of floats): linkage distance thresholds
+
+    Returns:
+        dict: keys of distance thresholds, values of number of clusters
+    """
+    n_merges = np.searchsorted(
+        np.sort(linkage_matrix[:, 2]), distance_thresholds, side="left"
+    )
+    return {
+        threshold: int(len(linkage_matrix) + 1 - merges)
+        for threshold, merges in zip(distance_thresholds, n_merges)
+    }
+
+
+class LinkageTreeClustering:
+    """Agglomerative clustering that cuts a saved linkage matrix. The full
+    linkage matrix for an embedding is only computed the first time it is
+    clustered, after that any distance threshold is a cheap cut of the saved
+    matrix. As sub clustering calls this for each class's sub embedding,
+    their linkage matrices are saved too.
+
+    Has the same labels_ and n_clusters_ attributes as AgglomerativeClustering,
+    although the cluster labels may be numbered in a different order.
+    """
+
+    def __init__(
+        self,
+        n_clusters=None,
+        distance_threshold=None,
+        affinity="euclidean",
+        linkage="ward",
+    ):
+        self.n_clusters = n_clusters
+        self.distance_threshold = distance_threshold
+        self.affinity = affinity
+        self.linkage = linkage
+
+    def fit(self, embedding):
+        """Load or compute the linkage matrix and cut it
+
+        Args:
+            embedding (array): skills embedding
+
+        Returns:
+            LinkageTreeClustering: fitted model
+        """
+        self.linkage_matrix_ = load_or_compute_linkage(
+            embedding, method=self.linkage, metric=self.affinity
+        )
+        self.labels_ = cut_linkage(
+            self.linkage_matrix_, self.n_clusters, self.distance_threshold
+        )
+        self.n_clusters_ = int(self.labels_.max()) + 1
+        return self
+
+
 def cluster(
     embedding,
     n_clusters=config["clustering"]["n_clusters"],
     distance_threshold=config["clustering"]["distance_threshold"],
     affinity=config["clustering"]["affinity"],
     linkage=config["clustering"]["linkage"],
+    backend=config["clustering"]["backend"],
+    n_neighbors=config["clustering"]["n_neighbors"],
 ):
-    """Creates, fits and returns a agglomerative clustering model
+    """Creates, fits and returns a clustering model
+
+    The backend can be:
+        'agglomerative': agglomerative clustering of every skill,
+            needs memory quadratic in the number of skills.
+        'knn_ward': agglomerative clustering only allowed to merge clusters
+            connected in a sparse k nearest neighbours graph.
+        'micro_cluster_ward': mini batch k-means micro clusters merged with
+            weighted Ward linkage, see MicroClusterWard.
+        'linkage_tree': cuts of a saved linkage matrix, so that trying
+            different distance thresholds does not refit, see LinkageTreeClustering.
 
     Args:
         embedding (array): skills embedding
@@ -37,12 +340,45 @@ def cluster(
                                         clusters will not be merged.
         affinity (str, optional): metric used to compute the linkage.
         linkage (str, optional): linkage criteria to use.
+        backend (str, optional): clustering backend to use.
+        n_neighbors (int, optional): number of nearest neighbours each skill
+                                is connected to, for the 'knn_ward' backend.
+
+    Returns:
+        model with labels_ and n_clusters_ attributes
     """
+    from sklearn.cluster import AgglomerativeClustering
+    from sklearn.neighbors import kneighbors_graph
+
+    if backend == "micro_cluster_ward":
+        if linkage != "ward" or affinity != "euclidean":
+            raise ValueError("micro_cluster_ward only supports euclidean ward linkage")
+        return MicroClusterWard(
+            n_clusters=n_clusters, distance_threshold=distance_threshold
+        ).fit(embedding)
+    if backend == "linkage_tree":
+        return LinkageTreeClustering(
+            n_clusters=n_clusters,
+            distance_threshold=distance_threshold,
+            affinity=affinity,
+            linkage=linkage,
+        ).fit(embedding)
+    if backend == "knn_ward":
+        connectivity = kneighbors_graph(
+            embedding,
+            n_neighbors=min(n_neighbors, len(embedding) - 1),
+            include_self=False,
+        )
+    elif backend == "agglomerative":
+        connectivity = None
+    else:
+        raise ValueError(f"Unknown clustering backend {backend}")
     clustering_model = AgglomerativeClustering(
         n_clusters=n_clusters,
         distance_threshold=distance_threshold,
         affinity=affinity,
         linkage=linkage,
+        connectivity=connectivity,
     )
     return clustering_model.fit(embedding)
 
@@ -55,10 +391,10 @@ def find_indices(cluster_assignment, class_id):
         class_id (str): class identifier
 
     Returns:
-        array: indices of skills that have cluster_assignment matching class_id
+        array: 1 dimensional array of indices of skills that have
+            cluster_assignment matching class_id
     """
-    indices = np.argwhere(cluster_assignment == class_id)
-    return np.squeeze(indices)
+    return np.flatnonzero(cluster_assignment == class_id)
 
 
 def find_sub_embeddings(embedding, indices):
@@ -71,21 +407,66 @@ def find_sub_embeddings(embedding, indices):
     Returns:
         array: sub emebedding containing skills that match provided indices
     """
-    return np.asarray([embedding[i] for i in indices])
+    return embedding[indices]
 
 
-def sub_cluster_assignment(sub_clustering_model, class_id):
+def sub_cluster_assignment(sub_cluster_labels, class_id):
     """Assign sub clusters
 
     Args:
-        sub_clustering_model (AgglomerativeClustering):  model that has been fit on sub cluster
+        sub_cluster_labels (array): labels from the model that has been fit on sub cluster
         class_id (str)): class identifier
 
     Returns:
         array: sub cluster assignments, example: if assigned to class 1 and subclass 2,
             it would have sub cluster assignment of 1.2
     """
-    return np.asarray([(class_id + c / 10) for c in sub_clustering_model.labels_])
+    return class_id + np.asarray(sub_cluster_labels) / 10
+
+
+def fit_sub_cluster_labels(
+    embedding, indices, distance_threshold, backend=config["clustering"]["backend"]
+):
+    """Cluster the skills of one class
+
+    Args:
+        embedding (array): skills embedding
+        indices (array): indices of the skills in the class
+        distance_threshold (int): linkage distance threshold above which,
+                                clusters will not be merged.
+        backend (str, optional): clustering backend to use, see cluster
+
+    Returns:
+        array: sub cluster labels of the skills in the class
+    """
+    if len(indices) < 2:
+        # a class with a single skill can not be clustered, it is its own subclass
+        return np.zeros(len(indices), dtype=int)
+    return cluster(
+        find_sub_embeddings(embedding, indices),
+        distance_threshold=distance_threshold,
+        backend=backend,
+    ).labels_
+
+
+def fit_sub_clusters(
+    embedding_path, indices, distance_threshold, backend=config["clustering"]["backend"]
+):
+    """Cluster the skills of one class, reading the embedding from a memory map
+    so that it does not need to be pickled and sent to each worker process
+
+    Args:
+        embedding_path (str): path to .npy file of the skills embedding
+        indices (array): indices of the skills in the class
+        distance_threshold (int): linkage distance threshold above which,
+                                clusters will not be merged.
+        backend (str, optional): clustering backend to use, see cluster
+
+    Returns:
+        array: sub cluster labels of the skills in the class
+    """
+    embedding = np.load(embedding_path, mmap_mode="r")
+    return fit_sub_cluster_labels(embedding, indices, distance_threshold, backend)
 
 
 def full_sub_cluster_assignment(
@@ -93,8 +474,12 @@ def full_sub_cluster_assignment(
     cluster_assignments,
     num_clusters,
     distances=config["clustering"]["sub_clustering_distances"],
+    n_jobs=config["clustering"]["n_jobs"],
+    backend=config["clustering"]["backend"],
 ):
-    """Assign subclusters to all skills
+    """Assign subclusters to all skills. Each class is clustered independently,
+    so if n_jobs is greater than one the classes are clustered in parallel
+    worker processes which share the embedding through a memory map.
 
     Args:
         embedding (array): skill descriptions embedding
@@ -102,23 +487,52 @@ def full_sub_cluster_assignment(
         num_clusters (int): total number of clusters
         distances (list of ints, optional): linkage distance thresholds for each subcluster
                                         above which, clusters will not be merged.
+        n_jobs (int, optional): number of worker processes to cluster classes with
+        backend (str, optional): clustering backend to use, see cluster
 
     Returns:
         array: subcluster assignments for all skills
     """
-    full_sub_cluster_assignments = np.empty(shape=(len(embedding),))
-    for class_id in range(num_clusters):
-        indices = find_indices(cluster_assignments, class_id)
-        sub_embeddings = find_sub_embeddings(embedding, indices)
-        sub_clustering_model = cluster(
-            sub_embeddings, distance_threshold=distances[class_id]
+    if len(distances) < num_clusters:
+        raise ValueError(
+            f"{len(distances)} sub clustering distances were given "
+            f"for {num_clusters} classes, there must be one for each class"
         )
-        sub_cluster_assignments = sub_cluster_assignment(sub_clustering_model, class_id)
-        for i, a in zip(indices, sub_cluster_assignments):
-            full_sub_cluster_assignments[i] = a
+    class_indices = [
+        find_indices(cluster_assignments, class_id) for class_id in range(num_clusters)
+    ]
+    if n_jobs > 1:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            embedding_path = os.path.join(tmp_dir, "embedding.npy")
+            np.save(embedding_path, embedding)
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                # map returns the labels in class order, so results are deterministic
+                sub_cluster_labels = list(
+                    executor.map(
+                        fit_sub_clusters,
+                        repeat(embedding_path),
+                        class_indices,
+                        distances[:num_clusters],
+                        repeat(backend),
+                    )
+                )
+    else:
+        sub_cluster_labels = [
+            fit_sub_cluster_labels(embedding, indices, distances[class_id], backend)
+            for class_id, indices in enumerate(class_indices)
+        ]
+
+    full_sub_cluster_assignments = np.empty(shape=(len(embedding),))
+    full_sub_cluster_assignments[np.concatenate(class_indices)] = np.concatenate(
+        [
+            sub_cluster_assignment(labels, class_id)
+            for class_id, labels in enumerate(sub_cluster_labels)
+        ]
+    )
     return full_sub_cluster_assignments
 
 
+@instrument
 def cluster_add_ids(skills, embedding):
     """Cluster the skills descriptions and add
     a column for their cluster ids
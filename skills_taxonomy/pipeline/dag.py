@@ -0,0 +1,139 @@
+"""A small runner for pipelines made of stages that pass artifacts through files.
+
+Each stage declares the files it reads, the files it writes and the config keys
+it depends on. A stage's fingerprint is a hash of its name, the contents of its
+input files and the values of its config keys. The fingerprint of each stage's
+last successful run is saved, and when the pipeline is run again a stage is
+skipped if its fingerprint is unchanged and its outputs still exist. As the
+outputs of a stage are the inputs of the stages after it, a stage that produces
+different outputs causes the stages downstream of it to run again.
+"""
+import hashlib
+import json
+from pathlib import Path
+from skills_taxonomy import logger
+from skills_taxonomy.utils.fingerprint import file_fingerprint
+from skills_taxonomy.utils.json_management import load_json, save_json
+
+
+class Stage:
+    """A pipeline stage
+
+    Args:
+        name (str): name of the stage
+        run (callable): function with no arguments that reads the inputs
+            and writes the outputs
+        inputs (list of Paths): files the stage reads
+        outputs (list of Paths): files the stage writes
+        config_keys (list of strs): dotted config keys the stage depends on,
+            for example 'informative_words.num_words'
+    """
+
+    def __init__(self, name, run, inputs=(), outputs=(), config_keys=()):
+        self.name = name
+        self.run = run
+        self.inputs = [Path(path) for path in inputs]
+        self.outputs = [Path(path) for path in outputs]
+        self.config_keys = list(config_keys)
+
+
+def config_value(config, key):
+    """Find the value of a dotted config key
+
+    Args:
+        config (dict): config
+        key (str): dotted config key, for example 'informative_words.num_words'
+
+    Returns:
+        value of the key in config
+    """
+    value = config
+    for part in key.split("."):
+        value = value[part]
+    return value
+
+
+def stage_fingerprint(stage, config):
+    """Fingerprint a stage from its name, input file contents and config values
+
+    Args:
+        stage (Stage): stage to fingerprint
+        config (dict): config
+
+    Returns:
+        str: hex digest of the stage
+    """
+    fingerprint = {
+        "stage": stage.name,
+        "config": {key: config_value(config, key) for key in stage.config_keys},
+        "inputs": {str(path): file_fingerprint(path) for path in stage.inputs},
+    }
+    return hashlib.sha256(
+        json.dumps(fingerprint, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def order_stages(stages):
+    """Order stages so that each stage comes after the stages that write its inputs
+
+    Args:
+        stages (list of Stages): stages to order
+
+    Returns:
+        list of Stages: stages in the order to run them
+    """
+    writers = {path: stage.name for stage in stages for path in stage.outputs}
+    upstream = {
+        stage.name: {writers[path] for path in stage.inputs if path in writers}
+        for stage in stages
+    }
+    ordered = []
+    while len(ordered) < len(stages):
+        # take the first ready stage so stages keep their given order where possible
+        ready = next(
+            (
+                stage
+                for stage in stages
+                if stage not in ordered
+                and upstream[stage.name] <= {done.name for done in ordered}
+            ),
+            None,
+        )
+        if ready is None:
+            raise ValueError("Pipeline stages contain a cycle")
+        ordered.append(ready)
+    return ordered
+
+
+def run_stages(stages, config, state_dir, force=()):
+    """Run the stages whose inputs or config have changed since their last run
+
+    Args:
+        stages (list of Stages): stages of the pipeline
+        config (dict): config
+        state_dir (Path): directory to save the fingerprint of each stage's last run
+        force (list of strs): names of stages to run even if unchanged
+    """
+    for stage in order_stages(stages):
+        missing = [path for path in stage.inputs if not path.exists()]
+        if missing:
+            raise FileNotFoundError(
+                f"Inputs of stage {stage.name} are missing: {missing}"
+            )
+        fingerprint = stage_fingerprint(stage, config)
+        state_path = Path(state_dir) / f"{stage.name}.json"
+        if (
+            stage.name not in force
+            and state_path.exists()
+            and load_json(state_path)["fingerprint"] == fingerprint
+            and all(path.exists() for path in stage.outputs)
+        ):
+            logger.info(f"Skipping stage {stage.name}, inputs and config unchanged")
+            continue
+        logger.info(f"Running stage {stage.name}")
+        stage.run()
+        save_json(
+            f"{state_dir}/",
+            file_name=f"{stage.name}.json",
+            json_to_save={"fingerprint": fingerprint},
+        )
@@ -1,54 +1,500 @@
 """Functions to create, load and save skills embedding
+
+Descriptions are embedded with a sentence transformer. As encoding is the
+slowest part of the pipeline, every embedded description is also stored in
+a persistent cache keyed by the model name and a hash of the description text,
+so that re-runs only need to encode descriptions that have not been seen before.
+
+Descriptions are encoded with either the torch sentence transformer or, with
+sentence_transformer.backend: "onnx", an int8 ONNX export of it (see
+onnx_encoder.py). The two backends' embeddings are cached separately.
+
+The final embedding is saved as a raw binary data file with a small json sidecar,
+and loaded as a memory map rather than unpickled. It can optionally be stored
+as float16 or per dimension scalar quantised int8 to reduce its size.
 """
-from sentence_transformers import SentenceTransformer
-import pickle
+from functools import lru_cache
+import hashlib
+import numpy as np
+import os
+import time
+from tqdm import tqdm
 from skills_taxonomy import config, logger, PROJECT_DIR
 from skills_taxonomy.utils.dir_management import make_dir_if_not_exist
+from skills_taxonomy.utils.json_management import load_json, save_json
+from skills_taxonomy.utils.instrumentation import instrument
+
+# Version of the on-disk embedding format written by save_embedding
+EMBEDDING_FORMAT_VERSION = 1
+
+
+def hash_description(description):
+    """Hash a skill description to use as an embedding cache key
+
+    Args:
+        description (str): skill description
+
+    Returns:
+        str: hex digest of the description text
+    """
+    return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+
+def embedding_cache_dir(
+    model_name,
+    cache_dir=PROJECT_DIR / "outputs/models/embedding_cache",
+    backend=config["sentence_transformer"]["backend"],
+):
+    """Find the embedding cache directory for a sentence transformer model
+
+    Args:
+        model_name (str): name of the sentence transformer model
+        cache_dir (Path, optional): root directory of the embedding cache,
+                            defaults to PROJECT_DIR/"outputs/models/embedding_cache"
+        backend (str, optional): backend the model is run with, 'torch' or 'onnx'
+
+    Returns:
+        Path: directory containing the cached embeddings for model_name
+    """
+    model_dir = model_name.replace("/", "_")
+    return cache_dir / (model_dir if backend == "torch" else f"{model_dir}_{backend}")
+
+
+class EmbeddingCache:
+    """Persistent cache of the embeddings of descriptions for one model.
+
+    The cache is stored as shards, each a keys_<i>.npy file of description hashes
+    and a vectors_<i>.npy file of their embeddings. New embeddings are added as a
+    new shard so the existing cache is never rewritten, and shards are loaded as
+    memory maps so only the description hashes are held in memory.
+
+    Args:
+        model_cache_dir (Path): directory containing the cached embeddings for a model
+    """
+
+    def __init__(self, model_cache_dir):
+        self.model_cache_dir = model_cache_dir
+        self.locations = {}
+        self.shards = []
+        while (model_cache_dir / f"keys_{len(self.shards)}.npy").exists():
+            self._load_shard(len(self.shards))
+
+    def _load_shard(self, shard):
+        keys = np.load(self.model_cache_dir / f"keys_{shard}.npy")
+        self.shards.append(
+            np.load(self.model_cache_dir / f"vectors_{shard}.npy", mmap_mode="r")
+        )
+        self.locations.update({key: (shard, row) for row, key in enumerate(keys)})
+
+    def __contains__(self, key):
+        return key in self.locations
+
+    def add(self, keys, vectors):
+        """Add description hashes and their embeddings to the cache as a new shard
+
+        Args:
+            keys (list of strs): description hashes
+            vectors (array): embeddings, row i is the embedding of the description
+                with hash keys[i]
+        """
+        shard = len(self.shards)
+        make_dir_if_not_exist(self.model_cache_dir)
+        np.save(self.model_cache_dir / f"keys_{shard}.npy", np.asarray(keys, "U64"))
+        np.save(self.model_cache_dir / f"vectors_{shard}.npy", vectors)
+        self._load_shard(shard)
+
+    def get(self, keys):
+        """Get the embeddings of cached descriptions
+
+        Args:
+            keys (list of strs): description hashes, all of which are in the cache
+
+        Returns:
+            array: embeddings, row i is the embedding of the description with hash keys[i]
+        """
+        if not self.shards:
+            # nothing has been cached, so the embedding dimension is unknown
+            return np.empty((len(keys), 0), dtype=np.float32)
+        locations = np.asarray([self.locations[key] for key in keys]).reshape(-1, 2)
+        embedding = np.empty(
+            (len(keys), self.shards[0].shape[1]), dtype=self.shards[0].dtype
+        )
+        for shard in np.unique(locations[:, 0]):
+            in_shard = locations[:, 0] == shard
+            embedding[in_shard] = self.shards[shard][locations[in_shard, 1]]
+        return embedding
+
+
+def token_lengths(embedder, corpus):
+    """Count the number of tokens the embedder's tokenizer produces for each text
+
+    Args:
+        embedder (SentenceTransformer): sentence transformer model
+        corpus (list of strs): texts to tokenize
+
+    Returns:
+        array: number of tokens in each text, truncated to the model's max sequence length
+    """
+    input_ids = embedder.tokenizer(
+        corpus, truncation=True, max_length=embedder.max_seq_length
+    )["input_ids"]
+    return np.asarray([len(ids) for ids in input_ids])
+
+
+def token_budget_batches(sorted_lengths, max_batch_tokens):
+    """Split texts sorted by token length into batches, where each batch is as
+    large as possible without its padded size exceeding max_batch_tokens.
+    Every text is padded to the longest text in its batch, so the padded size
+    of a batch is its number of texts multiplied by its longest token length.
+
+    Args:
+        sorted_lengths (array): number of tokens in each text, in ascending order
+        max_batch_tokens (int): maximum padded number of tokens in a batch,
+                            a text longer than this gets a batch to itself
+
+    Returns:
+        list of slices: positions of the texts in each batch
+    """
+    batches = []
+    batch_start = 0
+    for i, length in enumerate(sorted_lengths):
+        # lengths are sorted so the text being added is the longest in the batch
+        if i > batch_start and (i + 1 - batch_start) * length > max_batch_tokens:
+            batches.append(slice(batch_start, i))
+            batch_start = i
+    batches.append(slice(batch_start, len(sorted_lengths)))
+    return batches
+
+
+def encode_corpus(
+    embedder,
+    corpus,
+    batch_size=config["sentence_transformer"]["batch_size"],
+    num_workers=config["sentence_transformer"]["num_workers"],
+    max_batch_tokens=config["sentence_transformer"]["max_batch_tokens"],
+):
+    """Encode texts, sorted by token length so that batches contain texts
+    of similar lengths and little padding.
+
+    If num_workers is greater than one and the embedder is a SentenceTransformer,
+    the sorted texts are sharded across a pool
+    of worker processes which each hold their own copy of the model. Otherwise, if
+    max_batch_tokens is set, batches are sized by a padded token budget rather
+    than a fixed number of texts.
+
+    Args:
+        embedder (SentenceTransformer or OnnxSentenceEncoder): sentence transformer model
+        corpus (list of strs): texts to encode
+        batch_size (int, optional): number of texts to encode at once
+        num_workers (int, optional): number of worker processes to encode with
+        max_batch_tokens (int or None, optional): maximum padded number of tokens
+                            in a batch, if None batches of batch_size texts are used
+
+    Returns:
+        array: embedding of corpus, in the same order as corpus
+    """
+    lengths = token_lengths(embedder, corpus)
+    order = np.argsort(lengths, kind="stable")
+    sorted_corpus = [corpus[i] for i in order]
+    start_time = time.perf_counter()
+    if num_workers > 1 and hasattr(embedder, "start_multi_process_pool"):
+        # split the cpu threads between the workers rather than every worker using all of them
+        os.environ.setdefault(
+            "OMP_NUM_THREADS", str(max(1, os.cpu_count() // num_workers))
+        )
+        pool = embedder.start_multi_process_pool(target_devices=["cpu"] * num_workers)
+        try:
+            sorted_embedding = embedder.encode_multi_process(
+                sorted_corpus, pool, batch_size=batch_size
+            )
+        finally:
+            embedder.stop_multi_process_pool(pool)
+    elif max_batch_tokens is None:
+        sorted_embedding = embedder.encode(
+            sorted_corpus, batch_size=batch_size, show_progress_bar=True
+        )
+    else:
+        batches = token_budget_batches(lengths[order], max_batch_tokens)
+        sorted_embedding = np.vstack(
+            [
+                embedder.encode(
+                    sorted_corpus[batch],
+                    batch_size=batch.stop - batch.start,
+                    show_progress_bar=False,
+                )
+                for batch in tqdm(batches, desc="Batches")
+            ]
+        )
+    elapsed = time.perf_counter() - start_time
+    logger.info(
+        f"Encoded {lengths.sum()} tokens in {elapsed:.1f}s "
+        f"({lengths.sum() / elapsed:.0f} tokens/sec)"
+    )
+    embedding = np.empty_like(sorted_embedding)
+    embedding[order] = sorted_embedding
+    return embedding
+
+
+@lru_cache(maxsize=None)
+def load_sentence_transformer(
+    model_name, backend=config["sentence_transformer"]["backend"]
+):
+    """Load a sentence transformer model, only once per process
+
+    Args:
+        model_name (str): name of the sentence transformer model
+        backend (str, optional): 'torch' to run the model with sentence_transformers,
+            or 'onnx' to run its int8 ONNX export with ONNX Runtime
+
+    Returns:
+        SentenceTransformer or OnnxSentenceEncoder: sentence transformer model
+    """
+    if backend == "onnx":
+        from skills_taxonomy.pipeline.onnx_encoder import load_onnx_encoder
+
+        return load_onnx_encoder(model_name)
+    if backend != "torch":
+        raise ValueError(f"Unknown sentence transformer backend {backend}")
+    # imported here as importing sentence_transformers imports torch, which is slow
+    from sentence_transformers import SentenceTransformer
 
+    return SentenceTransformer(model_name)
 
-def create_embedding(skills):
-    """Create embedding using sentence transformer
+
+@instrument
+def create_embedding(
+    skills,
+    cache_dir=PROJECT_DIR / "outputs/models/embedding_cache",
+    model_name=config["sentence_transformer"]["model"],
+    backend=config["sentence_transformer"]["backend"],
+    embedding_cache=None,
+    embedder=None,
+):
+    """Create embedding using sentence transformer, only encoding
+    descriptions that are not already in the embedding cache
 
     Args:
         skills (df): skills dataframe containing column containing
                 description of the skill
+        cache_dir (Path, optional): root directory of the embedding cache,
+                            defaults to PROJECT_DIR/"outputs/models/embedding_cache"
+        model_name (str, optional): name of the sentence transformer model
+        backend (str, optional): backend to run the model with, 'torch' or 'onnx'
+        embedding_cache (EmbeddingCache, optional): already loaded embedding cache
+            to use instead of loading it from cache_dir
+        embedder (SentenceTransformer, optional): model to encode with
+            instead of the model loaded from model_name
 
     Returns:
         array: skill descriptions embedding
     """
     corpus = list(skills["description"].values)
-    embedder = SentenceTransformer(config["sentence_transformer"]["model"])
-    embedding = embedder.encode(corpus, show_progress_bar=True)
-    return embedding
+    if embedding_cache is None:
+        embedding_cache = EmbeddingCache(
+            embedding_cache_dir(model_name, cache_dir, backend)
+        )
+    keys = [hash_description(description) for description in corpus]
+
+    unseen = {
+        key: description
+        for key, description in zip(keys, corpus)
+        if key not in embedding_cache
+    }
+    logger.info(
+        f"{len(corpus) - len(unseen)} of {len(corpus)} descriptions found in embedding cache"
+    )
+
+    if unseen:
+        if embedder is None:
+            embedder = load_sentence_transformer(model_name, backend)
+        embedding_cache.add(
+            list(unseen.keys()), encode_corpus(embedder, list(unseen.values()))
+        )
 
+    return embedding_cache.get(keys)
 
-def save_embedding(embedding, save_path=PROJECT_DIR / "outputs/models/embedding.pkl"):
-    """Save skills embedding as pickle file
+
+def embedding_metadata_path(path):
+    """Find the path of the sidecar metadata file for an embedding data file
 
     Args:
-        embedding (array): skills embedding to be saved as pickle file
-        save_path (str, optional): path to save embedding,
-                            defaults to PROJECT_DIR/"outputs/models/embedding.pkl"
+        path (Path): path to embedding data file
+
+    Returns:
+        Path: path to the json sidecar describing the embedding data file
     """
+    return path.with_suffix(".json")
 
+
+def quantise_embedding(embedding, dtype):
+    """Quantise embedding to a smaller storage dtype
+
+    float16 embeddings are cast directly. int8 embeddings are scalar quantised,
+    each dimension is scaled so that its largest absolute value maps to 127.
+
+    Args:
+        embedding (array): float32 skills embedding
+        dtype (str): storage dtype, either 'float32', 'float16' or 'int8'
+
+    Returns:
+        array: quantised embedding
+        array: per dimension scale to multiply int8 values by to dequantise,
+            None if dtype is not 'int8'
+    """
+    if dtype in ("float32", "float16"):
+        return np.asarray(embedding, dtype=dtype), None
+    if dtype == "int8":
+        scale = np.abs(embedding).max(axis=0) / 127
+        scale[scale == 0] = 1
+        quantised = np.clip(np.rint(embedding / scale), -127, 127).astype(np.int8)
+        return quantised, scale.astype(np.float32)
+    raise ValueError(f"Unsupported embedding dtype {dtype}")
+
+
+def dequantise_embedding(quantised, scale=None):
+    """Convert a quantised embedding back to float32
+
+    Args:
+        quantised (array): quantised embedding
+        scale (array, optional): per dimension scale of an int8 embedding
+
+    Returns:
+        array: float32 skills embedding
+    """
+    embedding = np.asarray(quantised, dtype=np.float32)
+    return embedding if scale is None else embedding * np.asarray(scale, np.float32)
+
+
+def save_embedding_metadata(save_path, model_name, dtype, n_rows, dim, scale=None):
+    """Save the json sidecar of an embedding data file
+
+    Args:
+        save_path (Path): path of the embedding data file
+        model_name (str): name of the model used to create the embedding
+        dtype (str): storage dtype of the embedding
+        n_rows (int): number of rows in the embedding
+        dim (int): number of dimensions of the embedding
+        scale (array, optional): per dimension scale of an int8 embedding
+    """
+    metadata_path = embedding_metadata_path(save_path)
+    save_json(
+        f"{metadata_path.parent}/",
+        file_name=metadata_path.name,
+        json_to_save={
+            "format_version": EMBEDDING_FORMAT_VERSION,
+            "model": model_name,
+            "dtype": dtype,
+            "n_rows": n_rows,
+            "dim": dim,
+            "scale": None if scale is None else scale.tolist(),
+        },
+    )
+
+
+def save_embedding(
+    embedding,
+    save_path=PROJECT_DIR / "outputs/models/embedding.bin",
+    model_name=config["sentence_transformer"]["model"],
+    dtype=config["embedding"]["dtype"],
+):
+    """Save skills embedding as a raw binary data file, with a json sidecar
+    recording the format version, model name, dtype, row count and dimension
+
+    Args:
+        embedding (array): skills embedding to be saved
+        save_path (Path, optional): path to save embedding,
+                            defaults to PROJECT_DIR/"outputs/models/embedding.bin"
+        model_name (str, optional): name of the model used to create the embedding
+        dtype (str, optional): storage dtype, either 'float32', 'float16' or 'int8'
+    """
+    quantised, scale = quantise_embedding(embedding, dtype)
+    make_dir_if_not_exist(save_path.parent)
+    np.ascontiguousarray(quantised).tofile(save_path)
+    save_embedding_metadata(
+        save_path, model_name, quantised.dtype.name, *quantised.shape, scale=scale
+    )
+
+
+def save_embedding_batches(
+    skills_batches,
+    save_path=PROJECT_DIR / "outputs/models/embedding.bin",
+    model_name=config["sentence_transformer"]["model"],
+    dtype=config["embedding"]["dtype"],
+    cache_dir=PROJECT_DIR / "outputs/models/embedding_cache",
+    backend=config["sentence_transformer"]["backend"],
+):
+    """Create and save the embedding of batches of skills, appending each
+    batch's embedding to the data file so only one batch is held in memory
+
+    Args:
+        skills_batches (iterable of dfs): batches of skills dataframes containing
+            column containing description of the skill
+        save_path (Path, optional): path to save embedding,
+                            defaults to PROJECT_DIR/"outputs/models/embedding.bin"
+        model_name (str, optional): name of the model used to create the embedding
+        dtype (str, optional): storage dtype, either 'float32' or 'float16'
+        cache_dir (Path, optional): root directory of the embedding cache,
+                            defaults to PROJECT_DIR/"outputs/models/embedding_cache"
+        backend (str, optional): backend to run the model with, 'torch' or 'onnx'
+    """
+    if dtype == "int8":
+        raise ValueError(
+            "int8 embeddings are scaled using the whole embedding, use save_embedding"
+        )
+    embedding_cache = EmbeddingCache(
+        embedding_cache_dir(model_name, cache_dir, backend)
+    )
+    n_rows = 0
+    dim = None
     make_dir_if_not_exist(save_path.parent)
     with open(save_path, "wb") as out:
-        pickle.dump(embedding, out)
+        for skills in skills_batches:
+            if skills.empty:
+                continue
+            embedding = create_embedding(
+                skills,
+                model_name=model_name,
+                backend=backend,
+                embedding_cache=embedding_cache,
+            )
+            quantised, _ = quantise_embedding(embedding, dtype)
+            np.ascontiguousarray(quantised).tofile(out)
+            n_rows += len(quantised)
+            dim = quantised.shape[1]
+    if dim is None:
+        raise ValueError("There are no skills to embed in skills_batches")
+    save_embedding_metadata(save_path, model_name, dtype, n_rows, dim)
 
 
-def load_embedding(path=PROJECT_DIR / "outputs/models/embedding.pkl"):
-    """Load embedding from pickle file
+def load_embedding(path=PROJECT_DIR / "outputs/models/embedding.bin", dequantise=True):
+    """Load embedding as a read only memory map, so that processes
+    loading the same embedding share one page cached copy
 
     Args:
-        path (str): path to pickle file to load
+        path (Path): path to embedding data file to load
+        dequantise (bool): if the embedding was saved with a float16 or int8 dtype,
+            whether to convert it back to float32 in memory. If False the
+            memory map of the stored values is returned, defaults to True.
 
     Returns:
-        array: skills embedding loaded from pickle file
+        memmap or array: skills embedding
     """
     try:
-        with open(path, "rb") as inp:
-            embedding = pickle.load(inp)
-        return embedding
+        metadata = load_json(embedding_metadata_path(path))
+        if metadata["format_version"] != EMBEDDING_FORMAT_VERSION:
+            raise ValueError(
+                f"Embedding at {path} has format version {metadata['format_version']}, "
+                f"expected {EMBEDDING_FORMAT_VERSION}"
+            )
+        embedding = np.memmap(
+            path,
+            dtype=metadata["dtype"],
+            mode="r",
+            shape=(metadata["n_rows"], metadata["dim"]),
+        )
+        if not dequantise or metadata["dtype"] == "float32":
+            return embedding
+        return dequantise_embedding(embedding, metadata.get("scale"))
 
     except FileNotFoundError:
         logger.error(f"There is no embedding to load at {path}")
@@ -7,15 +7,82 @@ informative words in each class and subclass.
 TF-IDF is usually used to find informative words inside a document.
 But in our case we want to find informative words across a class or sub class.
 To do this we form a 'document' containing all texts from a class
-and then perform TF-IDF across on that 'document'.
+and then perform TF-IDF across on that 'document'. Rather than joining the
+texts, each skill description is tokenised once and the term counts of a
+class 'document' are the sums of the term counts of its descriptions.
 
 The top 3 functions below are from this
 implementation of class-TD-IDF https://github.com/MaartenGr/cTFIDF
 """
-from sklearn.feature_extraction.text import CountVectorizer
 import numpy as np
-from skills_taxonomy import PROJECT_DIR
+from scipy import sparse
+from skills_taxonomy import config, PROJECT_DIR
 from skills_taxonomy.utils.json_management import save_json
+from skills_taxonomy.utils.instrumentation import instrument
+
+
+def count_terms(descriptions, ngram_range=(1, 1)):
+    """Tokenise every skill description once and count its terms
+
+    Args:
+        descriptions (list of strs): skill descriptions
+        ngram_range (tuple): lower and upper boundary of the range of n-values
+                        for different word n-grams to be extracted.
+                        Defaults to (1, 1) i.e unigrams.
+
+    Returns:
+        csr_matrix: sparse matrix of term counts, with a row for each description
+        CountVectorizer: CountVectorizer which has been fit to descriptions
+    """
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    count = CountVectorizer(ngram_range=ngram_range, stop_words="english")
+    return count.fit_transform(descriptions).tocsr(), count
+
+
+def class_term_counts(term_counts, class_labels):
+    """Sum the term counts of the descriptions in each class, by multiplying
+    by a sparse class x description indicator matrix
+
+    Args:
+        term_counts (csr_matrix): term counts, with a row for each description
+        class_labels (array): class of each description
+
+    Returns:
+        array: sorted unique classes
+        csr_matrix: term counts, with a row for each class
+    """
+    classes, class_index = np.unique(class_labels, return_inverse=True)
+    indicator = sparse.csr_matrix(
+        (
+            np.ones(len(class_index)),
+            (class_index, np.arange(len(class_index))),
+        ),
+        shape=(len(classes), len(class_index)),
+    )
+    return classes, (indicator @ term_counts).tocsr()
+
+
+def c_tf_idf_from_counts(t, doc_length):
+    """Calculate class TF-IDF matrix from class term counts
+
+    The term counts and TF-IDF values are kept in sparse matrices,
+    so only the terms that appear in each class are stored.
+
+    Args:
+        t (csr_matrix): term counts, with a row for each class
+        doc_length (int): length of documents
+
+    Returns:
+        csr_matrix: sparse matrix of tf_idf values, with a row for each class
+            and a column for each term
+    """
+    w = np.asarray(t.sum(axis=1)).ravel().astype(float)
+    w[w == 0] = 1
+    tf = sparse.diags(1 / w) @ t
+    sum_t = np.asarray(t.sum(axis=0)).ravel()
+    idf = np.log(np.divide(doc_length, sum_t))
+    return (tf @ sparse.diags(idf)).tocsr()
 
 
 def c_tf_idf(documents, doc_length, ngram_range=(1, 1)):
@@ -30,26 +97,22 @@ def c_tf_idf(documents, doc_length, ngram_range=(1, 1)):
                         Defaults to (1, 1) i.e unigrams.
 
     Returns:
-        array: matrix of tf_idf values
+        csr_matrix: sparse matrix of tf_idf values, with a row for each document
+            and a column for each term
         CountVectorizer: CountVectorizer which has been fit to documents
     """
-    count = CountVectorizer(ngram_range=ngram_range, stop_words="english").fit(
-        documents
-    )
-    t = count.transform(documents).toarray()
-    w = t.sum(axis=1)
-    tf = np.divide(t.T, w)
-    sum_t = t.sum(axis=0)
-    idf = np.log(np.divide(doc_length, sum_t)).reshape(-1, 1)
-    tf_idf = np.multiply(tf, idf)
-    return tf_idf, count
+    t, count = count_terms(documents, ngram_range)
+    return c_tf_idf_from_counts(t, doc_length), count
 
 
 def extract_top_n_words_per_topic(tf_idf, count, classes, n=20):
     """Extract the top N words for each topic
 
+    Only the nonzero values in each row are considered, and the top N
+    of them are selected with a partial sort.
+
     Args:
-        tf_idf (array): matrix of tf_idf values
+        tf_idf (csr_matrix): sparse matrix of tf_idf values, with a row for each class
         count (CountVectorizer): CountVectorizer which has been fit to documents
         classes (list of ints): list of class ids
         n (int): number of most informative words to find, defaults to 20
@@ -58,38 +121,51 @@ def extract_top_n_words_per_topic(tf_idf, count, classes, n=20):
         dict: top N words for each topic
     """
     words = count.get_feature_names()
-    tf_idf_transposed = tf_idf.T
-    indices = tf_idf_transposed.argsort()[:, -n:]
-    top_n_words = {
-        label: [(words[j], tf_idf_transposed[i][j]) for j in indices[i]][::-1]
-        for i, label in enumerate(classes)
-    }
+    top_n_words = {}
+    for i, label in enumerate(classes):
+        row = slice(tf_idf.indptr[i], tf_idf.indptr[i + 1])
+        values, columns = tf_idf.data[row], tf_idf.indices[row]
+        if len(values) > n:
+            top = np.argpartition(-values, n - 1)[:n]
+            values, columns = values[top], columns[top]
+        order = np.argsort(-values, kind="stable")
+        top_n_words[label] = [
+            (words[j], values[k]) for k, j in zip(order, columns[order])
+        ]
     return top_n_words
 
 
-def view_top_n_words(skills, class_level):
+def view_top_n_words(
+    skills,
+    class_level,
+    n=config["informative_words"]["num_words"],
+    term_counts=None,
+    count=None,
+):
     """View top N most informative words for skill class or subclass
 
     Args:
         skills (df): dataframe of skills with descriptions
         class_level (str): what class level to use ('class_id' or 'subclass_id')
+        n (int): number of most informative words to find
+        term_counts (csr_matrix, optional): term counts of each skill description
+            from count_terms, computed if not given
+        count (CountVectorizer, optional): CountVectorizer which term_counts came from
 
     Returns:
         dict: top N words for each class or subclass
     """
-    skills_classid = skills[["description", class_level]]
-    skills_classid["skill_id"] = range(len(skills_classid))
-    skills_per_class = skills_classid.groupby([class_level], as_index=False).agg(
-        {"description": " ".join}
-    )
-    classes = skills_per_class[class_level]
-    tf_idf_class, count_class = c_tf_idf(
-        skills_per_class.description.values, doc_length=len(skills)
+    if term_counts is None:
+        term_counts, count = count_terms(skills["description"].values)
+    classes, t = class_term_counts(term_counts, skills[class_level].values)
+    tf_idf_class = c_tf_idf_from_counts(t, doc_length=len(skills))
+    top_n_words = extract_top_n_words_per_topic(
+        tf_idf_class, count, classes.tolist(), n=n
     )
-    top_n_words = extract_top_n_words_per_topic(tf_idf_class, count_class, classes)
     return top_n_words
 
 
+@instrument
 def save_informative_words(
     skills, save_dir=f"{PROJECT_DIR}/outputs/most_informative_words/"
 ):
@@ -100,15 +176,21 @@ def save_informative_words(
         save_dir (str): path to directory to save json,
             defaults to f"{PROJECT_DIR}/outputs/most_informative_words/".
     """
+    # tokenise the descriptions once for both class levels
+    term_counts, count = count_terms(skills["description"].values)
     # save most informative words for classes
     save_json(
         save_dir,
         file_name="class.json",
-        json_to_save=view_top_n_words(skills, class_level="class_id"),
+        json_to_save=view_top_n_words(
+            skills, class_level="class_id", term_counts=term_counts, count=count
+        ),
     )
     # save most informative words for subclasses
     save_json(
         save_dir,
         file_name="subclass.json",
-        json_to_save=view_top_n_words(skills, class_level="subclass_id"),
+        json_to_save=view_top_n_words(
+            skills, class_level="subclass_id", term_counts=term_counts, count=count
+        ),
     )
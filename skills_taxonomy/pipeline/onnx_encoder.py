@@ -0,0 +1,259 @@
+"""Encode skill descriptions with an int8 ONNX export of the sentence transformer.
+
+The transformer of the sentence transformer model is exported once to an ONNX
+graph with dynamic batch and sequence axes, and its weights are quantised to
+int8 with ONNX Runtime's dynamic quantisation. The exported graph and the
+tokenizer are cached locally, so later runs load them without torch.
+
+OnnxSentenceEncoder has the tokenizer, max_seq_length and encode method of a
+SentenceTransformer that encode_corpus uses, so it can be used in its place.
+The token embeddings are mean pooled over the attention mask, as the pooling
+of paraphrase-distilroberta-base-v1 is, and normalised to unit length.
+
+The encoder is selected with sentence_transformer.backend: "onnx" in the config.
+Its embeddings are cached separately from the torch embeddings, and can be
+compared to them with backend_agreement_report.
+
+Usage:
+    python skills_taxonomy/pipeline/onnx_encoder.py
+"""
+from functools import lru_cache
+import time
+import numpy as np
+from skills_taxonomy import config, logger, PROJECT_DIR
+from skills_taxonomy.utils.dir_management import make_dir_if_not_exist
+from skills_taxonomy.utils.json_management import load_json, save_json
+
+ONNX_INPUTS = ["input_ids", "attention_mask"]
+
+
+def onnx_export_dir(model_name, export_dir=PROJECT_DIR / "outputs/models/onnx"):
+    """Find the directory of the ONNX export of a sentence transformer model
+
+    Args:
+        model_name (str): name of the sentence transformer model
+        export_dir (Path, optional): root directory of the ONNX exports,
+                            defaults to PROJECT_DIR/"outputs/models/onnx"
+
+    Returns:
+        Path: directory containing the ONNX export of model_name
+    """
+    return export_dir / model_name.replace("/", "_")
+
+
+def export_onnx_model(model_name, model_export_dir):
+    """Export the transformer of a sentence transformer model to ONNX, quantise
+    its weights to int8, and save it with the tokenizer
+
+    Args:
+        model_name (str): name of the sentence transformer model
+        model_export_dir (Path): directory to save the export to
+    """
+    # imported here as torch is only needed to export the model
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sentence_transformers import SentenceTransformer
+    import torch
+
+    class LastHiddenState(torch.nn.Module):
+        """Return only the token embeddings of the transformer"""
+
+        def __init__(self, transformer):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, input_ids, attention_mask):
+            return self.transformer(input_ids=input_ids, attention_mask=attention_mask)[
+                0
+            ]
+
+    model = SentenceTransformer(model_name, device="cpu")
+    make_dir_if_not_exist(model_export_dir)
+    tokens = model.tokenizer(["an example skill description"], return_tensors="pt")
+    with torch.no_grad():
+        torch.onnx.export(
+            LastHiddenState(model[0].auto_model.eval()),
+            tuple(tokens[name] for name in ONNX_INPUTS),
+            str(model_export_dir / "model.onnx"),
+            input_names=ONNX_INPUTS,
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                name: {0: "batch", 1: "sequence"}
+                for name in ONNX_INPUTS + ["last_hidden_state"]
+            },
+            opset_version=14,
+        )
+    quantize_dynamic(
+        str(model_export_dir / "model.onnx"),
+        str(model_export_dir / "model_int8.onnx"),
+        weight_type=QuantType.QInt8,
+    )
+    model.tokenizer.save_pretrained(str(model_export_dir))
+    save_json(
+        f"{model_export_dir}/",
+        "encoder.json",
+        {"model": model_name, "max_seq_length": model.max_seq_length},
+    )
+    logger.info(f"Exported {model_name} to {model_export_dir}")
+
+
+class OnnxSentenceEncoder:
+    """Encode texts with an ONNX export of a sentence transformer model
+
+    Args:
+        model_export_dir (Path): directory the model was exported to
+        quantised (bool): whether to use the int8 quantised graph
+        n_threads (int, optional): number of threads ONNX Runtime uses
+            within an operation, if None it uses all the cpu cores
+    """
+
+    def __init__(self, model_export_dir, quantised=True, n_threads=None):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        options = onnxruntime.SessionOptions()
+        if n_threads is not None:
+            options.intra_op_num_threads = n_threads
+        graph = "model_int8.onnx" if quantised else "model.onnx"
+        self.session = onnxruntime.InferenceSession(
+            str(model_export_dir / graph),
+            options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_export_dir))
+        self.max_seq_length = load_json(model_export_dir / "encoder.json")[
+            "max_seq_length"
+        ]
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, **kwargs):
+        """Encode texts to mean pooled, unit length embeddings
+
+        Args:
+            sentences (list of strs): texts to encode
+            batch_size (int): number of texts to encode at once
+            show_progress_bar (bool): unused, for compatibility with
+                SentenceTransformer.encode
+
+        Returns:
+            array: float32 embedding of sentences
+        """
+        batches = []
+        for start in range(0, len(sentences), batch_size):
+            tokens = self.tokenizer(
+                list(sentences[start : start + batch_size]),
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np",
+            )
+            inputs = {name: tokens[name].astype(np.int64) for name in ONNX_INPUTS}
+            token_embeddings = self.session.run(None, inputs)[0]
+            mask = inputs["attention_mask"][:, :, None].astype(np.float32)
+            embedding = (token_embeddings * mask).sum(axis=1) / np.maximum(
+                mask.sum(axis=1), 1e-9
+            )
+            batches.append(
+                embedding
+                / np.maximum(np.linalg.norm(embedding, axis=1, keepdims=True), 1e-12)
+            )
+        if not batches:
+            return np.zeros((0, self.session.get_outputs()[0].shape[2]), np.float32)
+        return np.vstack(batches).astype(np.float32)
+
+
+@lru_cache(maxsize=None)
+def load_onnx_encoder(
+    model_name, export_dir=PROJECT_DIR / "outputs/models/onnx", quantised=True
+):
+    """Load the ONNX encoder of a sentence transformer model, exporting
+    the model first if it has not been exported yet
+
+    Args:
+        model_name (str): name of the sentence transformer model
+        export_dir (Path, optional): root directory of the ONNX exports,
+                            defaults to PROJECT_DIR/"outputs/models/onnx"
+        quantised (bool): whether to use the int8 quantised graph
+
+    Returns:
+        OnnxSentenceEncoder: encoder of the model
+    """
+    model_export_dir = onnx_export_dir(model_name, export_dir)
+    if not (model_export_dir / "encoder.json").exists():
+        export_onnx_model(model_name, model_export_dir)
+    return OnnxSentenceEncoder(model_export_dir, quantised)
+
+
+def backend_agreement_report(
+    skills, model_name=config["sentence_transformer"]["model"], k=10, n_queries=1000
+):
+    """Compare the ONNX int8 embedding of skills to the torch embedding
+
+    Args:
+        skills (df): preprocessed skills dataframe with descriptions
+        model_name (str, optional): name of the sentence transformer model
+        k (int): number of neighbours to compare, defaults to 10
+        n_queries (int): number of skills to compare neighbours for, defaults to 1000
+
+    Returns:
+        dict: cosine similarity between each skill's torch and ONNX embeddings,
+            neighbour overlap, class and subclass agreement and encoding times
+    """
+    from sklearn.metrics import adjusted_rand_score
+    from skills_taxonomy.pipeline.clustering import (
+        cluster_add_ids,
+        normalise_embedding,
+    )
+    from skills_taxonomy.pipeline.embedding import (
+        encode_corpus,
+        load_sentence_transformer,
+    )
+    from skills_taxonomy.pipeline.quantisation_report import (
+        neighbour_overlap,
+        top_k_neighbours,
+    )
+
+    corpus = list(skills["description"].values)
+    embeddings = {}
+    seconds = {}
+    for backend in ["torch", "onnx"]:
+        embedder = load_sentence_transformer(model_name, backend)
+        start_time = time.perf_counter()
+        embeddings[backend] = normalise_embedding(encode_corpus(embedder, corpus))
+        seconds[backend] = time.perf_counter() - start_time
+    cosine = np.einsum("ij,ij->i", embeddings["torch"], embeddings["onnx"])
+    query_indices = np.random.default_rng(0).choice(
+        len(corpus), size=min(n_queries, len(corpus)), replace=False
+    )
+    clustered = {
+        backend: cluster_add_ids(skills, embedding)
+        for backend, embedding in embeddings.items()
+    }
+    return {
+        "model": model_name,
+        "n_skills": len(corpus),
+        "cosine_mean": float(cosine.mean()),
+        "cosine_min": float(cosine.min()),
+        "cosine_p1": float(np.percentile(cosine, 1)),
+        f"top_{k}_neighbour_overlap": neighbour_overlap(
+            top_k_neighbours(embeddings["torch"], query_indices, k),
+            top_k_neighbours(embeddings["onnx"], query_indices, k),
+        ),
+        **{
+            f"{level}_adjusted_rand_index": float(
+                adjusted_rand_score(clustered["torch"][level], clustered["onnx"][level])
+            )
+            for level in ["class_id", "subclass_id"]
+        },
+        "torch_seconds": seconds["torch"],
+        "onnx_seconds": seconds["onnx"],
+        "speedup": seconds["torch"] / seconds["onnx"],
+    }
+
+
+if __name__ == "__main__":
+    from skills_taxonomy.getters.esco_skills import get_output_skills
+
+    report = backend_agreement_report(
+        get_output_skills(f"{PROJECT_DIR}/outputs/skills/preprocessed_skills.csv")
+    )
+    logger.info(f"ONNX backend agreement: {report}")
+    save_json(f"{PROJECT_DIR}/outputs/reports/", "onnx_agreement.json", report)
@@ -1,8 +1,36 @@
 """Preprocessing of skills file
+
+Skills can be preprocessed all at once, or in chunks so that files larger
+than memory can be preprocessed.
 """
-from skills_taxonomy.getters.esco_skills import get_skills
+import pandas as pd
+from skills_taxonomy import config, PROJECT_DIR
+from skills_taxonomy.getters.esco_skills import (
+    get_skills,
+    get_skills_chunks,
+    SKILLS_COLUMNS,
+)
+from skills_taxonomy.utils.instrumentation import instrument
+
+
+@instrument
+def filter_skills(skills, min_num_words=config["skills"]["min_num_words"]):
+    """Remove rows with descriptions containing min_num_words or fewer words
+    and drop unused columns
+
+    Args:
+        skills (df): skills
+        min_num_words (int, optional): rows with descriptions with this many words
+            or fewer are removed
+
+    Returns:
+        df: filtered skills
+    """
+    n_words_desc = skills["description"].str.count(r"\S+")
+    return skills.loc[n_words_desc > min_num_words, SKILLS_COLUMNS]
 
 
+@instrument
 def preprocess_skills():
     """Preprocess skills by removing rows with descriptions
     containing two or fewer words and dropping unused columns
@@ -10,12 +38,28 @@ def preprocess_skills():
     Returns:
         df: processed skills
     """
-    skills = get_skills()
-    return (
-        skills.assign(
-            n_words_desc=skills["description"].apply(lambda x: len(x.split()))
-        )
-        .query("n_words_desc > 2")
-        .reset_index(drop=True)
-        .loc[:, ["preferredLabel", "altLabels", "description"]]
-    )
+    return filter_skills(get_skills()).reset_index(drop=True)
+
+
+def preprocess_skills_chunks(
+    skills_path=f"{PROJECT_DIR}/inputs/data/skills_en.csv",
+    chunksize=config["skills"]["chunksize"],
+):
+    """Preprocess skills in chunks, so that peak memory depends on the chunk size
+    rather than the file size. Each processed chunk has a row index continuing
+    from the previous chunk, matching the index from preprocess_skills.
+
+    Args:
+        skills_path (str): path to skills csv,
+            defaults to f"{PROJECT_DIR}/inputs/data/skills_en.csv"
+        chunksize (int): number of rows to read at once
+
+    Yields:
+        df: chunk of processed skills
+    """
+    n_rows = 0
+    for skills in get_skills_chunks(skills_path, chunksize):
+        skills = filter_skills(skills)
+        skills.index = pd.RangeIndex(n_rows, n_rows + len(skills))
+        n_rows += len(skills)
+        yield skills
@@ -0,0 +1,98 @@
+"""Functions to measure how much storing the embedding as float16 or int8
+changes the results of the pipeline compared to the full precision embedding.
+
+Two things are compared: the top level cluster assignments, using the adjusted
+rand index, and the top 10 most similar skills for a sample of skills, using
+the fraction of the full precision neighbours that are also found with the
+quantised embedding.
+"""
+import numpy as np
+from skills_taxonomy import PROJECT_DIR
+from skills_taxonomy.pipeline.clustering import cluster, normalise_embedding
+from skills_taxonomy.utils.json_management import save_json
+
+
+def top_k_neighbours(embedding, query_indices, k=10):
+    """Find the k most similar skills by cosine similarity for each query skill
+
+    Args:
+        embedding (array): skills embedding
+        query_indices (array): indices of skills to find neighbours for
+        k (int): number of neighbours to find, defaults to 10
+
+    Returns:
+        array: indices of the k nearest neighbours of each query skill,
+            excluding the query skill itself
+    """
+    embedding = normalise_embedding(embedding)
+    similarities = embedding[query_indices] @ embedding.T
+    similarities[np.arange(len(query_indices)), query_indices] = -np.inf
+    return np.argpartition(-similarities, k, axis=1)[:, :k]
+
+
+def neighbour_overlap(full_neighbours, quantised_neighbours):
+    """Find the mean fraction of full precision neighbours found with the
+    quantised embedding
+
+    Args:
+        full_neighbours (array): neighbour indices from the full precision embedding
+        quantised_neighbours (array): neighbour indices from the quantised embedding
+
+    Returns:
+        float: mean overlap between 0 and 1
+    """
+    return float(
+        np.mean(
+            [
+                len(np.intersect1d(full, quantised)) / len(full)
+                for full, quantised in zip(full_neighbours, quantised_neighbours)
+            ]
+        )
+    )
+
+
+def quantisation_report(embedding, quantised_embedding, k=10, n_queries=1000):
+    """Compare a quantised embedding, after it has been dequantised,
+    to the full precision embedding
+
+    Args:
+        embedding (array): full precision skills embedding
+        quantised_embedding (array): dequantised skills embedding
+        k (int): number of neighbours to compare, defaults to 10
+        n_queries (int): number of skills to compare neighbours for, defaults to 1000
+
+    Returns:
+        dict: reconstruction error, cluster agreement and neighbour overlap
+    """
+    from sklearn.metrics import adjusted_rand_score
+
+    rng = np.random.default_rng(0)
+    query_indices = rng.choice(
+        len(embedding), size=min(n_queries, len(embedding)), replace=False
+    )
+    full_labels = cluster(normalise_embedding(embedding)).labels_
+    quantised_labels = cluster(normalise_embedding(quantised_embedding)).labels_
+    return {
+        "max_abs_error": float(np.abs(embedding - quantised_embedding).max()),
+        "cluster_adjusted_rand_index": float(
+            adjusted_rand_score(full_labels, quantised_labels)
+        ),
+        "n_clusters_full": int(len(np.unique(full_labels))),
+        "n_clusters_quantised": int(len(np.unique(quantised_labels))),
+        f"top_{k}_neighbour_overlap": neighbour_overlap(
+            top_k_neighbours(embedding, query_indices, k),
+            top_k_neighbours(quantised_embedding, query_indices, k),
+        ),
+    }
+
+
+def save_quantisation_report(report, dtype, save_dir=f"{PROJECT_DIR}/outputs/reports/"):
+    """Save quantisation report as json
+
+    Args:
+        report (dict): quantisation report
+        dtype (str): storage dtype the report is for
+        save_dir (str): path to directory to save json,
+            defaults to f"{PROJECT_DIR}/outputs/reports/".
+    """
+    save_json(save_dir, file_name=f"quantisation_{dtype}.json", json_to_save=report)
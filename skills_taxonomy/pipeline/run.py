@@ -1,34 +1,250 @@
-from skills_taxonomy.pipeline.preprocessing import preprocess_skills
+"""Run the skills taxonomy pipeline.
+
+Each step of the pipeline is a stage that reads and writes files in outputs/.
+Stages are only re-run when their input files or config have changed since
+their last run, for example changing informative_words.num_words only re-runs
+the informative words stage and the stages after it.
+
+Usage:
+    python skills_taxonomy/pipeline/run.py [--force STAGE_NAME]
+"""
+from typing import List
+import typer
+from skills_taxonomy.getters.esco_skills import (
+    get_output_skills,
+    get_output_skills_chunks,
+)
+from skills_taxonomy.pipeline.preprocessing import preprocess_skills_chunks
 from skills_taxonomy.pipeline.embedding import (
     create_embedding,
     save_embedding,
+    save_embedding_batches,
     load_embedding,
 )
+from skills_taxonomy.pipeline.quantisation_report import (
+    quantisation_report,
+    save_quantisation_report,
+)
+from skills_taxonomy.pipeline.all_pairs import all_pairs_top_k
+from skills_taxonomy.pipeline.assign_skills import (
+    CENTROID_ARRAYS,
+    subclass_centroids,
+    save_centroids,
+)
 from skills_taxonomy.pipeline.clustering import cluster_add_ids
+from skills_taxonomy.pipeline.dag import Stage, run_stages
 from skills_taxonomy.pipeline.informative_words import save_informative_words
 from skills_taxonomy.pipeline.name_clusters import save_named_clusters
 from skills_taxonomy.pipeline.add_labels import add_labels
-from skills_taxonomy import PROJECT_DIR
+from skills_taxonomy.utils.dir_management import make_dir_if_not_exist
+from skills_taxonomy.utils.instrumentation import (
+    enable_instrumentation,
+    save_run_report,
+)
+from skills_taxonomy import config, PROJECT_DIR
+
+RAW_SKILLS_PATH = PROJECT_DIR / "inputs/data/skills_en.csv"
+PREPROCESSED_SKILLS_PATH = PROJECT_DIR / "outputs/skills/preprocessed_skills.csv"
+EMBEDDING_PATH = PROJECT_DIR / "outputs/models/embedding.bin"
+CLUSTERED_SKILLS_PATH = PROJECT_DIR / "outputs/skills/clustered_skills.parquet"
+ALL_PAIRS_DIR = PROJECT_DIR / "outputs/models/all_pairs"
+CENTROIDS_DIR = PROJECT_DIR / "outputs/models/centroids"
+INFORMATIVE_WORDS_DIR = PROJECT_DIR / "outputs/most_informative_words"
+NAMED_CLASSES_DIR = PROJECT_DIR / "outputs/named_classes"
+LABELLED_SKILLS_PATH = PROJECT_DIR / "outputs/skills/labelled_skills.parquet"
+STATE_DIR = PROJECT_DIR / "outputs/pipeline_state"
+
+
+def save_skills(skills, save_path, append=False):
+    """Save skills dataframe as parquet or csv, depending on the extension
+    of save_path, making its directory if it does not exist
+
+    Args:
+        skills (df): skills dataframe
+        save_path (Path): path to save parquet or csv
+        append (bool): whether to append the rows to an existing csv,
+            defaults to False
+    """
+    make_dir_if_not_exist(save_path.parent)
+    if save_path.suffix == ".parquet":
+        skills.to_parquet(save_path)
+    else:
+        skills.to_csv(save_path, mode="a" if append else "w", header=not append)
+
+
+def run_preprocessing():
+    """Load and preprocess skills in chunks"""
+    for i, skills in enumerate(preprocess_skills_chunks(RAW_SKILLS_PATH)):
+        save_skills(skills, PREPROCESSED_SKILLS_PATH, append=i > 0)
+
 
-# load skills
-skills = preprocess_skills()
+def run_embedding():
+    """Create and save embedding. Full precision embeddings are created in
+    chunks of skills, quantised embeddings are created all at once so they
+    can be scaled and compared to the full precision embedding in a report"""
+    if config["embedding"]["dtype"] == "float32":
+        save_embedding_batches(
+            get_output_skills_chunks(PREPROCESSED_SKILLS_PATH), EMBEDDING_PATH
+        )
+    else:
+        embedding = create_embedding(get_output_skills(PREPROCESSED_SKILLS_PATH))
+        save_embedding(embedding, EMBEDDING_PATH)
+        save_quantisation_report(
+            quantisation_report(embedding, load_embedding(EMBEDDING_PATH)),
+            dtype=config["embedding"]["dtype"],
+        )
 
-# create embedding
-embedding = create_embedding(skills)
-save_embedding(embedding)
-embedding = load_embedding()
 
-# cluster skills and add cluster and subcluster id cols to skills
-skills = cluster_add_ids(skills, embedding)
+def run_all_pairs():
+    """Find the most similar skills to every skill"""
+    all_pairs_top_k(load_embedding(EMBEDDING_PATH), ALL_PAIRS_DIR)
+
+
+def run_clustering():
+    """Cluster skills and add cluster and subcluster id cols to skills"""
+    skills = cluster_add_ids(
+        get_output_skills(PREPROCESSED_SKILLS_PATH), load_embedding(EMBEDDING_PATH)
+    )
+    save_skills(skills, CLUSTERED_SKILLS_PATH)
+
+
+def run_centroids():
+    """Save subclass centroids to assign new skills to"""
+    save_centroids(
+        subclass_centroids(
+            get_output_skills(
+                CLUSTERED_SKILLS_PATH, columns=["class_id", "subclass_id"]
+            ),
+            load_embedding(EMBEDDING_PATH),
+        ),
+        CENTROIDS_DIR,
+    )
+
+
+def run_informative_words():
+    """Create informative words for classes and subclasses"""
+    save_informative_words(get_output_skills(CLUSTERED_SKILLS_PATH))
+
+
+def run_labelling():
+    """Add class and subclass labels to skills"""
+    save_skills(
+        add_labels(get_output_skills(CLUSTERED_SKILLS_PATH)), LABELLED_SKILLS_PATH
+    )
+
+
+STAGES = [
+    Stage(
+        "preprocessing",
+        run_preprocessing,
+        inputs=[RAW_SKILLS_PATH],
+        outputs=[PREPROCESSED_SKILLS_PATH],
+        config_keys=["skills"],
+    ),
+    Stage(
+        "embedding",
+        run_embedding,
+        inputs=[PREPROCESSED_SKILLS_PATH],
+        outputs=[EMBEDDING_PATH, EMBEDDING_PATH.with_suffix(".json")],
+        config_keys=[
+            "sentence_transformer.model",
+            "sentence_transformer.backend",
+            "embedding",
+        ],
+    ),
+    Stage(
+        "clustering",
+        run_clustering,
+        inputs=[
+            PREPROCESSED_SKILLS_PATH,
+            EMBEDDING_PATH,
+            EMBEDDING_PATH.with_suffix(".json"),
+        ],
+        outputs=[CLUSTERED_SKILLS_PATH],
+        config_keys=["clustering"],
+    ),
+    Stage(
+        "centroids",
+        run_centroids,
+        inputs=[
+            CLUSTERED_SKILLS_PATH,
+            EMBEDDING_PATH,
+            EMBEDDING_PATH.with_suffix(".json"),
+        ],
+        outputs=[CENTROIDS_DIR / f"{name}.npy" for name in CENTROID_ARRAYS],
+        config_keys=["assignment.novelty_quantile"],
+    ),
+    Stage(
+        "informative_words",
+        run_informative_words,
+        inputs=[CLUSTERED_SKILLS_PATH],
+        outputs=[
+            INFORMATIVE_WORDS_DIR / "class.json",
+            INFORMATIVE_WORDS_DIR / "subclass.json",
+        ],
+        config_keys=["informative_words"],
+    ),
+    Stage(
+        "name_clusters",
+        save_named_clusters,
+        inputs=[
+            INFORMATIVE_WORDS_DIR / "class.json",
+            INFORMATIVE_WORDS_DIR / "subclass.json",
+        ],
+        outputs=[
+            NAMED_CLASSES_DIR / "named_classes.json",
+            NAMED_CLASSES_DIR / "named_subclasses.json",
+        ],
+    ),
+    # labels are read from the hand checked copies of the named classes
+    Stage(
+        "labelling",
+        run_labelling,
+        inputs=[
+            CLUSTERED_SKILLS_PATH,
+            NAMED_CLASSES_DIR / "named_classes_x.json",
+            NAMED_CLASSES_DIR / "named_subclasses_x.json",
+        ],
+        outputs=[LABELLED_SKILLS_PATH],
+    ),
+]
+
+# an offline job comparing every pair of skills, only run when asked for
+ALL_PAIRS_STAGE = Stage(
+    "all_pairs",
+    run_all_pairs,
+    inputs=[EMBEDDING_PATH, EMBEDDING_PATH.with_suffix(".json")],
+    outputs=[ALL_PAIRS_DIR / "neighbours.npy", ALL_PAIRS_DIR / "similarities.npy"],
+    config_keys=["all_pairs.k"],
+)
+
+app = typer.Typer()
 
-# create informative words
-save_informative_words()
 
-# name clusters
-save_named_clusters()
+@app.command()
+def run(
+    force: List[str] = typer.Option(
+        [], help="Name of a stage to run even if its inputs and config are unchanged"
+    ),
+    instrument: bool = typer.Option(
+        config["instrumentation"]["enabled"],
+        help="Record the time, memory and data sizes of each step in a run report",
+    ),
+    all_pairs: bool = typer.Option(
+        config["all_pairs"]["enabled"],
+        help="Also find the most similar skills to every skill",
+    ),
+):
+    """Run the pipeline stages whose inputs or config have changed"""
+    enable_instrumentation(instrument)
+    try:
+        stages = STAGES + [ALL_PAIRS_STAGE] if all_pairs else STAGES
+        run_stages(stages, config, STATE_DIR, force=force)
+    finally:
+        if instrument:
+            save_run_report()
 
-# add labels
-add_labels(skills)
 
-# save updated skills
-skills.to_csv(f"{PROJECT_DIR}/outputs/skills/skills_after_labels2.csv")
+# guarded so that encoding worker processes do not re-run the pipeline on import
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,294 @@
+"""A local HTTP service to find the skills most similar to a skill or to free text.
+
+The labelled skills, embedding, nearest neighbour index and sentence transformer
+model are loaded once when the service starts, rather than on every query.
+Free text queries are encoded in micro batches: a query waits up to
+max_wait_ms for other queries to arrive, and they are encoded together.
+Encoded texts are kept in an LRU cache so repeated queries are not re-encoded.
+
+Endpoints:
+    /similar?skill_id=<int>&k=<int>   skills most similar to a skill
+    /similar?text=<str>&k=<int>       skills most similar to free text
+    /metrics                          p50 and p99 latency and failures of each endpoint
+
+Usage:
+    python skills_taxonomy/pipeline/similarity_service.py [--host HOST] [--port PORT]
+
+The model only needs an encode method that takes a list of texts and returns
+an array of embeddings, so the service can be tested with a stand-in model.
+"""
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import queue
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import typer
+from skills_taxonomy import config, logger
+from skills_taxonomy.getters.esco_skills import get_output_skills
+from skills_taxonomy.pipeline.ann_index import (
+    load_or_build_ann_index,
+    query_ann_index,
+)
+from skills_taxonomy.pipeline.embedding import (
+    load_embedding,
+    load_sentence_transformer,
+)
+
+SKILL_COLUMNS = [
+    "preferredLabel",
+    "class_id",
+    "class_lbl",
+    "subclass_id",
+    "subclass_lbl",
+]
+
+
+class EncoderBatcher:
+    """Encode texts from many threads in micro batches on one worker thread
+
+    Args:
+        embedder (SentenceTransformer): model with an encode method
+        max_batch_size (int): maximum number of texts to encode at once
+        max_wait_ms (float): how long the first text of a batch waits
+            for more texts to arrive
+    """
+
+    def __init__(self, embedder, max_batch_size=32, max_wait_ms=5):
+        self.embedder = embedder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def encode(self, text):
+        """Encode a text, blocking until its batch has been encoded
+
+        Args:
+            text (str): text to encode
+
+        Returns:
+            array: embedding of the text
+        """
+        future = Future()
+        self.requests.put((text, future))
+        return future.result()
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                embeddings = self.embedder.encode([text for text, _ in batch])
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(np.asarray(embedding))
+
+
+class LatencyMetrics:
+    """Record the latencies of recent requests to each endpoint,
+    and the total number of failed requests
+
+    Args:
+        window (int): number of recent requests to keep for each endpoint
+    """
+
+    def __init__(self, window=10_000):
+        self.latencies = defaultdict(lambda: deque(maxlen=window))
+        self.failures = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, seconds, failed=False):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            self.failures[endpoint] += failed
+
+    def summary(self):
+        """Find the p50 and p99 latency in milliseconds of each endpoint
+
+        Returns:
+            dict: count of recent requests, total failures, p50_ms and p99_ms
+                of each endpoint
+        """
+        with self.lock:
+            latencies = {key: np.array(value) for key, value in self.latencies.items()}
+            failures = dict(self.failures)
+        return {
+            endpoint: {
+                "count": len(values),
+                "failures": failures.get(endpoint, 0),
+                "p50_ms": float(np.percentile(values, 50) * 1000),
+                "p99_ms": float(np.percentile(values, 99) * 1000),
+            }
+            for endpoint, values in latencies.items()
+        }
+
+
+class SimilarityService:
+    """Find the skills most similar to a skill or to free text
+
+    Args:
+        skills (df): labelled skills dataframe, in the same order as the embedding
+        embedding (array): skills embedding
+        index (dict): approximate nearest neighbour index of the embedding
+        embedder (SentenceTransformer): model with an encode method
+        cache_size (int): number of encoded texts to cache
+        max_batch_size (int): maximum number of texts to encode at once
+        max_wait_ms (float): how long a text waits for others to encode with
+    """
+
+    def __init__(
+        self,
+        skills,
+        embedding,
+        index,
+        embedder,
+        cache_size=1024,
+        max_batch_size=32,
+        max_wait_ms=5,
+    ):
+        self.skills = skills[[c for c in SKILL_COLUMNS if c in skills]].reset_index(
+            drop=True
+        )
+        self.embedding = embedding
+        self.index = index
+        self.batcher = EncoderBatcher(embedder, max_batch_size, max_wait_ms)
+        self.encode_text = lru_cache(maxsize=cache_size)(self.batcher.encode)
+        self.metrics = LatencyMetrics()
+
+    def similar(self, query, k=10):
+        """Find the k skills most similar to a query embedding
+
+        Args:
+            query (array): query embedding
+            k (int): number of similar skills to find
+
+        Returns:
+            list of dicts: similar skills with their cosine scores, most similar first
+        """
+        neighbours, cosine_scores = query_ann_index(
+            self.index, self.embedding, query[None, :], k=k
+        )
+        found = np.isfinite(cosine_scores[0])
+        similar_skills = self.skills.iloc[neighbours[0][found]].assign(
+            skill_id=neighbours[0][found], cosine_score=cosine_scores[0][found]
+        )
+        return json.loads(similar_skills.to_json(orient="records"))
+
+    def similar_to_skill(self, skill_id, k=10):
+        """Find the k skills most similar to a skill, including the skill itself"""
+        if not 0 <= skill_id < len(self.embedding):
+            raise ValueError(
+                f"skill_id must be between 0 and {len(self.embedding) - 1}"
+            )
+        return self.similar(np.asarray(self.embedding[skill_id]), k)
+
+    def similar_to_text(self, text, k=10):
+        """Find the k skills most similar to free text"""
+        return self.similar(self.encode_text(text), k)
+
+
+class SimilarityRequestHandler(BaseHTTPRequestHandler):
+    """Handle requests to the SimilarityService of the server"""
+
+    def do_GET(self):
+        start_time = time.perf_counter()
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        service = self.server.service
+        if url.path == "/metrics":
+            self.send_json(200, service.metrics.summary())
+            return
+        if url.path != "/similar":
+            self.send_json(404, {"error": f"Unknown path {url.path}"})
+            return
+        endpoint = next((key for key in ["skill_id", "text"] if key in params), None)
+        try:
+            k = int(params.get("k", 10))
+            if endpoint == "skill_id":
+                status, body = 200, service.similar_to_skill(int(params["skill_id"]), k)
+            elif endpoint == "text":
+                status, body = 200, service.similar_to_text(params["text"], k)
+            else:
+                raise ValueError("Query needs a skill_id or text parameter")
+        except ValueError as error:
+            status, body = 400, {"error": str(error)}
+        except Exception as error:
+            logger.exception(f"Failed to handle {self.path}")
+            status, body = 500, {"error": f"{type(error).__name__}: {error}"}
+        self.send_json(status, body)
+        service.metrics.record(
+            endpoint or "invalid",
+            time.perf_counter() - start_time,
+            failed=status != 200,
+        )
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def make_server(service, host="127.0.0.1", port=8000):
+    """Make an HTTP server for a SimilarityService that handles each
+    request in its own thread
+
+    Args:
+        service (SimilarityService): service to handle requests with
+        host (str): host to listen on, defaults to localhost
+        port (int): port to listen on, 0 picks a free port
+
+    Returns:
+        ThreadingHTTPServer: server, call serve_forever to start it
+    """
+    server = ThreadingHTTPServer((host, port), SimilarityRequestHandler)
+    server.service = service
+    return server
+
+
+app = typer.Typer()
+
+
+@app.command()
+def serve(host: str = "127.0.0.1", port: int = 8000):
+    """Load the skills, embedding, index and model and serve similar skills"""
+    embedding = load_embedding()
+    service = SimilarityService(
+        get_output_skills(columns=SKILL_COLUMNS),
+        embedding,
+        load_or_build_ann_index(embedding),
+        load_sentence_transformer(config["sentence_transformer"]["model"]),
+    )
+    server = make_server(service, host, port)
+    logger.info(f"Serving similar skills on http://{host}:{server.server_port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    app()
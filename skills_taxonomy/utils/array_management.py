@@ -0,0 +1,28 @@
+import numpy as np
+from skills_taxonomy.utils.dir_management import make_dir_if_not_exist
+
+
+def save_arrays(arrays, names, save_dir):
+    """Save named arrays as .npy files, making save_dir if it does not exist
+
+    Args:
+        arrays (dict): keys of array name, values of array
+        names (list of strs): names of the arrays to save
+        save_dir (Path): directory to save the arrays
+    """
+    make_dir_if_not_exist(save_dir)
+    for name in names:
+        np.save(save_dir / f"{name}.npy", arrays[name])
+
+
+def load_arrays(names, load_dir):
+    """Load named arrays saved by save_arrays as memory maps
+
+    Args:
+        names (list of strs): names of the arrays to load
+        load_dir (Path): directory the arrays were saved to
+
+    Returns:
+        dict: keys of array name, values of array
+    """
+    return {name: np.load(load_dir / f"{name}.npy", mmap_mode="r") for name in names}
@@ -0,0 +1,36 @@
+import hashlib
+import numpy as np
+
+
+def array_fingerprint(array):
+    """Create a short fingerprint of an array's shape, dtype and values,
+    to use as a key for results cached on disk
+
+    Args:
+        array (array): array to fingerprint
+
+    Returns:
+        str: hex digest of the array
+    """
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{array.shape}{array.dtype.str}".encode("utf-8"))
+    digest.update(array.data)
+    return digest.hexdigest()
+
+
+def file_fingerprint(path, chunk_size=2**20):
+    """Create a fingerprint of a file's contents
+
+    Args:
+        path (str or Path): path to file to fingerprint
+        chunk_size (int): number of bytes to read at once, defaults to 1MB
+
+    Returns:
+        str: hex digest of the file
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,103 @@
+"""Record the time, memory and data sizes of pipeline functions.
+
+Decorating a function with @instrument records, for each call, its wall time,
+CPU time, the process's peak RSS, the rows and megabytes of its first
+dataframe or array argument and of its result, and its rows per second. Each
+record is logged and kept so that a run report of all the records can be saved.
+
+Instrumentation is enabled with instrumentation.enabled in the config or with
+enable_instrumentation. When it is disabled a decorated function only checks
+a flag before calling the original function.
+"""
+import functools
+import resource
+import sys
+import time
+from skills_taxonomy import config, logger, PROJECT_DIR
+from skills_taxonomy.utils.json_management import save_json
+
+_instrumentation = {"enabled": config["instrumentation"]["enabled"], "records": []}
+
+
+def enable_instrumentation(enabled=True):
+    """Enable or disable recording of instrumented functions
+
+    Args:
+        enabled (bool): whether to record instrumented functions
+    """
+    _instrumentation["enabled"] = enabled
+
+
+def instrumentation_enabled():
+    """Whether instrumented functions are being recorded"""
+    return _instrumentation["enabled"]
+
+
+def peak_rss_mb():
+    """Find the peak resident set size of the process so far in megabytes"""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on linux
+    return peak_rss / 2**20 if sys.platform == "darwin" else peak_rss / 2**10
+
+
+def data_size(data):
+    """Find the number of rows and megabytes of a dataframe or array
+
+    Args:
+        data: object to find the size of
+
+    Returns:
+        dict: rows and mb of data, or None if data is not a dataframe or array
+    """
+    if hasattr(data, "memory_usage"):
+        n_bytes = data.memory_usage(index=True).sum()
+    elif hasattr(data, "nbytes"):
+        n_bytes = data.nbytes
+    else:
+        return None
+    return {"rows": len(data), "mb": float(n_bytes) / 2**20}
+
+
+def instrument(func):
+    """Decorator to record the time, memory and data sizes of each call of func"""
+
+    @functools.wraps(func)
+    def instrumented(*args, **kwargs):
+        if not _instrumentation["enabled"]:
+            return func(*args, **kwargs)
+        peak_rss_before = peak_rss_mb()
+        start_wall_time = time.perf_counter()
+        start_cpu_time = time.process_time()
+        result = func(*args, **kwargs)
+        wall_time = time.perf_counter() - start_wall_time
+        input_size = next(
+            (size for size in map(data_size, args) if size is not None), None
+        )
+        record = {
+            "function": func.__name__,
+            "wall_time_s": wall_time,
+            "cpu_time_s": time.process_time() - start_cpu_time,
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_rss_increase_mb": peak_rss_mb() - peak_rss_before,
+            "input": input_size,
+            "output": data_size(result),
+            "rows_per_sec": input_size["rows"] / wall_time if input_size else None,
+        }
+        _instrumentation["records"].append(record)
+        logger.info(f"Instrumented {func.__name__}: {record}")
+        return result
+
+    return instrumented
+
+
+def save_run_report(
+    save_dir=f"{PROJECT_DIR}/outputs/reports/", file_name="run_report.json"
+):
+    """Save the records of the instrumented function calls of this run
+
+    Args:
+        save_dir (str): path to directory to save json,
+            defaults to f"{PROJECT_DIR}/outputs/reports/"
+        file_name (str): file name to save json, defaults to 'run_report.json'
+    """
+    save_json(save_dir, file_name, {"records": _instrumentation["records"]})